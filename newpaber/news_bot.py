@@ -3,12 +3,35 @@
 Telegram 群机器人 - 新闻 / 统计 / 积分 / 广告 / 曝光台 / 兑U / 新人欢迎 / 管理员积分管理 / 广告定时器
 """
 
-import os, re, sys, json, html, time, uuid, logging, requests, feedparser, pymysql
+import os, re, io, sys, json, html, time, uuid, queue, atexit, logging, threading, multiprocessing, requests, feedparser, pymysql
+import xml.etree.ElementTree as ET
+import logging.handlers
+from collections import OrderedDict
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+from functools import lru_cache
+from html.parser import HTMLParser
 from bs4 import BeautifulSoup
-from datetime import datetime, timedelta
+from urllib3.util.retry import Retry
+from datetime import datetime, timedelta, timezone
+from zoneinfo import ZoneInfo
 from dateutil import tz
 from dotenv import load_dotenv
-from typing import List, Tuple, Optional, Dict
+from typing import List, Tuple, Optional, Dict, Callable
+try:
+    import orjson  # 可选：C 实现，getUpdates 大批量时解码明显更快；没装就退回标准库
+    def _jdumps(o)->str: return orjson.dumps(o).decode()
+    _jloads = orjson.loads
+except ImportError:
+    def _jdumps(o)->str: return json.dumps(o, ensure_ascii=False)
+    _jloads = json.loads
+try:
+    import MySQLdb as _mysql  # 可选：mysqlclient（C 扩展，协议解析不占 Python CPU）；没装就用纯 Python 的 PyMySQL
+    import MySQLdb.cursors
+    _MySQLOperationalError, _MySQLProgrammingError = _mysql.OperationalError, _mysql.ProgrammingError
+except ImportError:
+    _mysql = pymysql
+    _MySQLOperationalError, _MySQLProgrammingError = pymysql.err.OperationalError, pymysql.err.ProgrammingError
 
 # ====================== ENV ======================
 load_dotenv()
@@ -18,16 +41,22 @@ if not BOT_TOKEN:
 API_BASE = f"https://api.telegram.org/bot{BOT_TOKEN}"
 
 LOCAL_TZ_NAME = os.getenv("LOCAL_TZ", "Asia/Shanghai")
-LOCAL_TZ = tz.gettz(LOCAL_TZ_NAME)
+try: LOCAL_TZ = ZoneInfo(LOCAL_TZ_NAME)
+except Exception: LOCAL_TZ = tz.gettz(LOCAL_TZ_NAME)  # 系统缺 tzdata 时退回 dateutil
 
 MYSQL_HOST = os.getenv("MYSQL_HOST", "127.0.0.1")
 MYSQL_PORT = int(os.getenv("MYSQL_PORT", "3306"))
 MYSQL_DB   = os.getenv("MYSQL_DB", "newsbot")
 MYSQL_USER = os.getenv("MYSQL_USER", "root")
 MYSQL_PASSWORD = os.getenv("MYSQL_PASSWORD", "")
+MYSQL_POOL_SIZE = int(os.getenv("MYSQL_POOL_SIZE", "25"))
 
 POLL_TIMEOUT = int(os.getenv("POLL_TIMEOUT", "50"))
 HTTP_TIMEOUT = int(os.getenv("HTTP_TIMEOUT", "65"))
+SCHEDULER_INTERVAL = float(os.getenv("SCHEDULER_INTERVAL", "10"))  # 定时任务最小间隔（秒），触发点按分钟对齐
+UPDATE_WORKERS = int(os.getenv("UPDATE_WORKERS", "4"))  # <=1 表示在轮询线程里串行处理
+OFFSET_FILE = os.getenv("OFFSET_FILE", os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "tg_update_offset"))
+OFFSET_DB_SYNC_SECONDS = int(os.getenv("OFFSET_DB_SYNC_SECONDS", "60"))
 
 INTERVAL_MINUTES = int(os.getenv("INTERVAL_MINUTES", "60"))
 NEWS_ITEMS_PER_CAT = int(os.getenv("NEWS_ITEMS_PER_CAT", "8"))
@@ -35,16 +64,24 @@ NEWS_ENABLED_DEFAULT = os.getenv("NEWS_ENABLED_DEFAULT", "1") == "1"
 NEWS_MEDIA = os.getenv("NEWS_MEDIA","0")=="1"
 NEWS_MEDIA_LIMIT = int(os.getenv("NEWS_MEDIA_LIMIT","4"))
 OG_FETCH_TIMEOUT = int(os.getenv("OG_FETCH_TIMEOUT","8"))
+SEND_WORKERS = max(1, int(os.getenv("SEND_WORKERS","4")))
+TG_SEND_RATE = float(os.getenv("TG_SEND_RATE","30"))  # Telegram 全局上限约 30 条/秒
+TG_GROUP_RATE_PER_MIN = float(os.getenv("TG_GROUP_RATE_PER_MIN","20"))  # 同一群约 20 条/分钟；<=0 关闭
+RSS_FETCH_TIMEOUT = int(os.getenv("RSS_FETCH_TIMEOUT","20"))
+RSS_PARSE_WORKERS = int(os.getenv("RSS_PARSE_WORKERS", str(min(4, os.cpu_count() or 1))))  # <=1 表示在本进程解析
 
 STATS_ENABLED = os.getenv("STATS_ENABLED","1")=="1"
 MIN_MSG_CHARS = int(os.getenv("MIN_MSG_CHARS","3"))
+MSG_FLUSH_SECONDS = float(os.getenv("MSG_FLUSH_SECONDS","2"))  # 发言计数写缓冲的落库间隔
+MSG_FLUSH_MAX_KEYS = int(os.getenv("MSG_FLUSH_MAX_KEYS","500"))  # 攒满这么多键立即落库
 
 WELCOME_PANEL_ENABLED = os.getenv("WELCOME_PANEL_ENABLED","1")=="1"
 WELCOME_EPHEMERAL_SECONDS = int(os.getenv("WELCOME_EPHEMERAL_SECONDS","60"))
 PANEL_EPHEMERAL_SECONDS = int(os.getenv("PANEL_EPHEMERAL_SECONDS","60"))
 POPUP_EPHEMERAL_SECONDS = int(os.getenv("POPUP_EPHEMERAL_SECONDS","60"))
 
-ADMIN_USER_IDS = {int(x) for x in re.split(r"[,\s]+", os.getenv("ADMIN_USER_IDS","").strip()) if x.isdigit()}
+_LIST_SEP_RE=re.compile(r"[,\s]+")  # 逗号/空白分隔的列表（ID 环境变量、定时点）
+ADMIN_USER_IDS = frozenset(int(x) for x in _LIST_SEP_RE.split(os.getenv("ADMIN_USER_IDS","").strip()) if x.isdigit())
 
 SCORE_CHECKIN_POINTS = int(os.getenv("SCORE_CHECKIN_POINTS","1"))
 TOP_REWARD_SIZE = int(os.getenv("TOP_REWARD_SIZE","10"))
@@ -59,8 +96,8 @@ STATS_DAILY_AT = os.getenv("STATS_DAILY_AT","23:50")
 STATS_MONTHLY_AT = os.getenv("STATS_MONTHLY_AT","00:10")
 DAILY_BROADCAST_AT = os.getenv("DAILY_BROADCAST_AT","23:59")
 
-NEWS_CHAT_IDS = [int(x) for x in re.split(r"[,\s]+", os.getenv("NEWS_CHAT_IDS","").strip()) if x.isdigit()]
-STATS_CHAT_IDS = [int(x) for x in re.split(r"[,\s]+", os.getenv("STATS_CHAT_IDS","").strip()) if x.isdigit()]
+NEWS_CHAT_IDS = frozenset(int(x) for x in _LIST_SEP_RE.split(os.getenv("NEWS_CHAT_IDS","").strip()) if x.isdigit())
+STATS_CHAT_IDS = frozenset(int(x) for x in _LIST_SEP_RE.split(os.getenv("STATS_CHAT_IDS","").strip()) if x.isdigit())
 
 AD_DEFAULT_ENABLED = os.getenv("AD_DEFAULT_ENABLED","1")=="1"
 
@@ -83,28 +120,46 @@ except Exception:
 logger = logging.getLogger("newsbot"); logger.setLevel(getattr(logging, LOG_LEVEL, logging.INFO))
 h = logging.StreamHandler(sys.stdout)
 h.setFormatter(logging.Formatter("%(asctime)s %(levelname)s [%(name)s] %(message)s","%Y-%m-%d %H:%M:%S"))
-logger.handlers.clear(); logger.addHandler(h)
-def log(level, msg, **ctx): logger.log(level, f"{msg} | {json.dumps(ctx,ensure_ascii=False)}" if ctx else msg)
+# 业务线程只把日志记录丢进队列，格式化和写 stdout 由监听线程做；退出时 stop() 把队列里剩下的写完
+_LOG_Q:"queue.SimpleQueue"=queue.SimpleQueue()
+_LOG_LISTENER=logging.handlers.QueueListener(_LOG_Q, h); _LOG_LISTENER.start(); atexit.register(_LOG_LISTENER.stop)
+logger.handlers.clear(); logger.addHandler(logging.handlers.QueueHandler(_LOG_Q))
+def log(level, msg, **ctx):
+    if not logger.isEnabledFor(level): return  # 级别不够时连上下文都不序列化
+    logger.log(level, f"{msg} | {_jdumps(ctx)}" if ctx else msg)
 
 # ====================== 工具 & Telegram ======================
 def tz_now() -> datetime: return datetime.now(tz=LOCAL_TZ)
-def utcnow() -> datetime: return datetime.utcnow().replace(tzinfo=tz.UTC)
+def utcnow() -> datetime: return datetime.now(timezone.utc)
+_HHMM_RE=re.compile(r"^\s*(\d{1,2}):(\d{2})\s*$")
 def parse_hhmm(s:str)->Tuple[int,int]:
-    m=re.match(r"^\s*(\d{1,2}):(\d{2})\s*$",s or ""); 
+    m=_HHMM_RE.match(s or ""); 
     if not m: return (0,0)
     return max(0,min(23,int(m.group(1)))), max(0,min(59,int(m.group(2))))
-def safe_html(s:str)->str: return html.escape(s or "",quote=False)
-
+def safe_html(s:str)->str:  # 即 html.escape(quote=False) 的内联版，省掉一层调用和 quote 分支
+    return (s or "").replace("&","&amp;").replace("<","&lt;").replace(">","&gt;")
+
+_SESSION=requests.Session()
+# 所有 Telegram 调用共用：keep-alive 复用到 api.telegram.org 的 TLS 连接；
+# 轮询线程 + 更新 worker + 发送 worker 会同时占用连接，池子要够大。
+# 只重试建连失败（请求还没发出去，sendMessage 也不会重复）；读超时/5xx 不重试，交给上层
+_SESSION.mount("https://", requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=32,
+                                                         max_retries=Retry(total=2, connect=2, read=0, status=0, backoff_factor=0.2)))
+@lru_cache(maxsize=32)
+def _url(method:str)->str: return f"{API_BASE}/{method}"
+def _markup_json(reply_markup)->str:
+    """reply_markup 可以是 dict，也可以是预先序列化好的 JSON 字符串（固定菜单），后者原样透传"""
+    return reply_markup if isinstance(reply_markup,str) else _jdumps(reply_markup)
 def http_get(method:str, params=None, json_data=None, files=None, timeout:Optional[int]=None):
-    url=f"{API_BASE}/{method}"; t=timeout or HTTP_TIMEOUT
+    url=_url(method); t=timeout or HTTP_TIMEOUT
     try:
         if json_data is not None:
-            r=requests.post(url,json=json_data,timeout=t)
+            r=_SESSION.post(url,json=json_data,timeout=t)
         elif files is not None:
-            r=requests.post(url,data=params or {},files=files,timeout=t)
+            r=_SESSION.post(url,data=params or {},files=files,timeout=t)
         else:
-            r=requests.get(url,params=params or {},timeout=t)
-        r.raise_for_status(); data=r.json()
+            r=_SESSION.get(url,params=params or {},timeout=t)
+        r.raise_for_status(); data=_jloads(r.content)
         if not data.get("ok"): log(logging.WARNING,"telegram api not ok",event="tg_api",cmd=method,err=str(data))
         return data
     except Exception as e:
@@ -113,23 +168,23 @@ def http_get(method:str, params=None, json_data=None, files=None, timeout:Option
 def send_message_html(chat_id:int, text:str, reply_to_message_id:Optional[int]=None, disable_preview:bool=True, reply_markup:Optional[dict]=None):
     payload={"chat_id":chat_id,"text":text,"parse_mode":"HTML","disable_web_page_preview":True if disable_preview else False}
     if reply_to_message_id: payload["reply_to_message_id"]=reply_to_message_id
-    if reply_markup: payload["reply_markup"]=json.dumps(reply_markup,ensure_ascii=False)
+    if reply_markup: payload["reply_markup"]=_markup_json(reply_markup)
     use_post = bool(reply_markup) or len(text)>3500
     try:
         if use_post:
-            r=requests.post(f"{API_BASE}/sendMessage",data=payload,timeout=HTTP_TIMEOUT); return r.json()
+            r=_SESSION.post(_url("sendMessage"),data=payload,timeout=HTTP_TIMEOUT); return _jloads(r.content)
         else:
             return http_get("sendMessage", params=payload)
     except Exception as e:
         log(logging.ERROR,"telegram api error",event="tg_api",cmd="sendMessage",error=str(e)); return None
 
 def edit_message_html(chat_id:int, message_id:int, text:str, disable_preview:bool=True, reply_markup:Optional[dict]=None):
-    url=f"{API_BASE}/editMessageText"
+    url=_url("editMessageText")
     payload={"chat_id":chat_id,"message_id":message_id,"text":text,"parse_mode":"HTML","disable_web_page_preview":True if disable_preview else False}
-    if reply_markup: payload["reply_markup"]=json.dumps(reply_markup,ensure_ascii=False)
+    if reply_markup: payload["reply_markup"]=_markup_json(reply_markup)
     try:
-        r=requests.post(url,data=payload,timeout=HTTP_TIMEOUT)
-        try: data=r.json()
+        r=_SESSION.post(url,data=payload,timeout=HTTP_TIMEOUT)
+        try: data=_jloads(r.content)
         except Exception: data={"ok":False,"description":r.text,"status_code":r.status_code}
         if not data.get("ok"):
             desc=(data.get("description") or "").lower()
@@ -147,8 +202,8 @@ def answer_callback_query(cb_id:str, text:str="", show_alert:bool=False):
         payload={"callback_query_id":cb_id}; 
         if text: payload["text"]=text
         if show_alert: payload["show_alert"]=True
-        r=requests.post(f"{API_BASE}/answerCallbackQuery",data=payload,timeout=min(5,HTTP_TIMEOUT))
-        try: data=r.json()
+        r=_SESSION.post(_url("answerCallbackQuery"),data=payload,timeout=min(5,HTTP_TIMEOUT))
+        try: data=_jloads(r.content)
         except Exception: data={"ok":False,"description":r.text}
         if not data.get("ok"):
             desc=(data.get("description") or "").lower()
@@ -159,51 +214,166 @@ def answer_callback_query(cb_id:str, text:str="", show_alert:bool=False):
     except Exception as e:
         log(logging.WARNING,"answerCallbackQuery error",event="tg_api",error=str(e)); return None
 
+# ---------- 异步发送：按 chat_id 分片到固定 worker（同群保序），全局令牌桶限速 ----------
+_RATE_LOCK=threading.Lock(); _RATE_TOKENS=TG_SEND_RATE; _RATE_TS=time.monotonic()
+def _rate_take():
+    global _RATE_TOKENS, _RATE_TS
+    while True:
+        with _RATE_LOCK:
+            now=time.monotonic()
+            _RATE_TOKENS=min(TG_SEND_RATE, _RATE_TOKENS+(now-_RATE_TS)*TG_SEND_RATE); _RATE_TS=now
+            if _RATE_TOKENS>=1: _RATE_TOKENS-=1; return
+            wait=(1-_RATE_TOKENS)/TG_SEND_RATE
+        time.sleep(wait)
+# 群内令牌桶（chat_id<0 才限）：同群的发送固定落在同一个 worker，桶状态无需加锁；提前等待比撞 429 再退避更平滑
+_CHAT_RATE:Dict[int,Tuple[float,float]]={}
+def _chat_rate_take(chat_id:int):
+    cap=TG_GROUP_RATE_PER_MIN; per_s=cap/60.0; now=time.monotonic()
+    tokens,ts=_CHAT_RATE.get(chat_id,(cap,now))
+    tokens=min(cap, tokens+(now-ts)*per_s)
+    if tokens<1:
+        time.sleep((1-tokens)/per_s); now=time.monotonic(); tokens=1.0
+    _CHAT_RATE[chat_id]=(tokens-1,now)
+_OUTBOX:List[queue.Queue]=[]; _OUTBOX_LOCK=threading.Lock()
+def _outbox_worker(q:queue.Queue):
+    while True:
+        chat_id,fn,args,kw=q.get()
+        try:
+            if TG_GROUP_RATE_PER_MIN>0 and chat_id<0: _chat_rate_take(chat_id)
+            if TG_SEND_RATE>0: _rate_take()
+            fn(*args, **kw)
+        except Exception: logger.exception("outbox send error")
+        finally: q.task_done()
+def outbox_put(chat_id:int, fn:Callable, *args, **kw):
+    """把一次发送（fn(*args,**kw)）排进该群的发送队列，立即返回"""
+    if not _OUTBOX:
+        with _OUTBOX_LOCK:
+            if not _OUTBOX:
+                for i in range(SEND_WORKERS):
+                    q=queue.Queue(); threading.Thread(target=_outbox_worker, args=(q,), name=f"outbox-{i}", daemon=True).start(); _OUTBOX.append(q)
+    _OUTBOX[hash(chat_id)%len(_OUTBOX)].put((chat_id,fn,args,kw))
+def outbox_drain():
+    for q in _OUTBOX: q.join()
+atexit.register(outbox_drain)
+
 # ====================== MySQL ======================
-_DB=None
+_DB_LOCAL=threading.local()  # DB-API 连接不是线程安全的：每个线程一条
 def _connect_mysql(dbname:Optional[str]=None):
-    return pymysql.connect(host=MYSQL_HOST,port=MYSQL_PORT,user=MYSQL_USER,password=MYSQL_PASSWORD,
-                           database=dbname,charset="utf8mb4",autocommit=True,cursorclass=pymysql.cursors.Cursor)
+    return _mysql.connect(host=MYSQL_HOST,port=MYSQL_PORT,user=MYSQL_USER,password=MYSQL_PASSWORD,
+                          database=dbname,charset="utf8mb4",autocommit=True,cursorclass=_mysql.cursors.Cursor)
 def get_conn():
-    global _DB
-    if _DB is None:
-        try: _DB=_connect_mysql(MYSQL_DB)
-        except pymysql.err.OperationalError as e:
+    db=getattr(_DB_LOCAL,"conn",None)
+    if db is None:
+        try: db=_connect_mysql(MYSQL_DB)
+        except _MySQLOperationalError as e:
             if e.args and e.args[0]==1049:
                 tmp=_connect_mysql("mysql")
                 with tmp.cursor() as c:
                     c.execute(f"CREATE DATABASE IF NOT EXISTS `{MYSQL_DB}` DEFAULT CHARSET utf8mb4 COLLATE utf8mb4_unicode_ci;")
-                tmp.close(); _DB=_connect_mysql(MYSQL_DB)
+                tmp.close(); db=_connect_mysql(MYSQL_DB)
             else:
                 log(logging.ERROR,"mysql connect error",error=str(e)); raise
+        _DB_LOCAL.conn=db
     else:
-        _DB.ping(reconnect=True)
-    return _DB
+        try: db.ping()  # PyMySQL 的 ping 默认自带重连；mysqlclient 断线会抛错，换一条新连接
+        except _MySQLOperationalError:
+            db=_DB_LOCAL.conn=_connect_mysql(MYSQL_DB)
+    return db
+# 可选连接池：装了 DBUtils 就用 PooledDB（取用时 ping），用完即还；没装则退回上面的线程本地直连。
+# 上限按同时可能查库的线程留足：更新 worker + 发送 worker + 调度 + 计数落库 + 各种临时线程池
+# 连接全是 autocommit、显式事务自己 commit/rollback，归还时不必再发一次 ROLLBACK（reset=False）
+# 上限由 MYSQL_POOL_SIZE 调；常驻 2 条、空闲最多留 5 条，其余用完即关
+try:
+    from dbutils.pooled_db import PooledDB
+except ImportError:
+    PooledDB = None
+_POOL=None; _POOL_LOCK=threading.Lock()
+def _db_pool():
+    global _POOL
+    if _POOL is None and PooledDB is not None:
+        with _POOL_LOCK:
+            if _POOL is None:
+                get_conn()  # 先直连一次：库不存在时在这里建好
+                _POOL=PooledDB(creator=_mysql, mincached=2, maxcached=5, maxconnections=MYSQL_POOL_SIZE, blocking=True, ping=1, reset=False,
+                               host=MYSQL_HOST, port=MYSQL_PORT, user=MYSQL_USER, password=MYSQL_PASSWORD,
+                               database=MYSQL_DB, charset="utf8mb4", autocommit=True)
+    return _POOL
+@contextmanager
+def db_conn():
+    pool=_db_pool()
+    if pool is None:
+        yield get_conn(); return
+    conn=pool.connection()
+    try: yield conn
+    finally: conn.close()
 def _exec(sql:str,args:tuple=()): 
-    with get_conn().cursor() as c: c.execute(sql,args); return c
+    with db_conn() as conn, conn.cursor() as c: c.execute(sql,args); return c
 def _fetchone(sql:str,args:tuple=()): 
-    with _exec(sql,args) as c: return c.fetchone()
+    with db_conn() as conn, conn.cursor() as c: c.execute(sql,args); return c.fetchone()
 def _fetchall(sql:str,args:tuple=()): 
-    with _exec(sql,args) as c: return c.fetchall()
+    with db_conn() as conn, conn.cursor() as c: c.execute(sql,args); return c.fetchall()
 def _safe_alter(sql:str):
     try: _exec(sql)
     except Exception: pass
 
+# msg_counts 按月 RANGE COLUMNS(day) 分区：日/月查询都是 day 等值或半开区间，只落到一个分区；
+# p_max 兜底，调度线程在月初把当月和下月从 p_max 里切出来
+_MSG_PART_YM=""  # 已确认有独立分区的最后一个月
+def _msg_part(ym:str)->str: return "p_"+ym.replace("-","_")
+def _msg_yms(first:str, last:str)->List[str]:
+    out=[first]
+    while out[-1]<last: out.append(_month_bounds(out[-1])[1][:7])
+    return out
+def _msg_parts_sql(yms:List[str])->str:
+    return "".join(f"PARTITION {_msg_part(m)} VALUES LESS THAN ('{_month_bounds(m)[1]}'), " for m in yms)+"PARTITION p_max VALUES LESS THAN (MAXVALUE)"
+def _msg_part_names()->set:
+    return {r[0] for r in _fetchall("SELECT PARTITION_NAME FROM information_schema.PARTITIONS WHERE TABLE_SCHEMA=DATABASE() "
+                                    "AND TABLE_NAME='msg_counts' AND PARTITION_NAME IS NOT NULL")}
+def msg_partitions_ensure(ym:Optional[str]=None):
+    global _MSG_PART_YM
+    ym=ym or tz_now().strftime("%Y-%m"); nxt=_month_bounds(ym)[1][:7]
+    if _MSG_PART_YM>=nxt: return
+    try:
+        names=_msg_part_names()
+        if names:  # 没分区（迁移失败）就不再折腾
+            last=max((n for n in names if n!="p_max"), default="")
+            missing=[m for m in (ym,nxt) if _msg_part(m)>last]
+            if missing:
+                _exec(f"ALTER TABLE msg_counts REORGANIZE PARTITION p_max INTO ({_msg_parts_sql(missing)})")
+    except Exception:
+        logger.exception("msg_counts partition rotate failed")  # 不重试到下个月，免得每轮调度都卡在 ALTER 上
+    _MSG_PART_YM=nxt
+
 def init_db():
+    ym=tz_now().strftime("%Y-%m"); nxt=_month_bounds(ym)[1][:7]
     _exec("""CREATE TABLE IF NOT EXISTS msg_counts (
         chat_id BIGINT NOT NULL, user_id BIGINT NOT NULL,
         username VARCHAR(64), first_name VARCHAR(64), last_name VARCHAR(64),
         day CHAR(10) NOT NULL, cnt INT NOT NULL DEFAULT 0,
         PRIMARY KEY (chat_id,user_id,day),
-        KEY idx_day (chat_id,day), KEY idx_user (chat_id,user_id)
-    ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci;""")
+        KEY idx_day_cnt (chat_id,day,cnt)
+    ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci
+    PARTITION BY RANGE COLUMNS(day) (""" + _msg_parts_sql(_msg_yms(ym, nxt)) + ")")
+    _safe_alter("ALTER TABLE msg_counts ADD KEY idx_day_cnt (chat_id,day,cnt)")
+    # 老库的 msg_counts 未分区：按已有数据的最早月份一次性重建成按月分区
+    if not _msg_part_names():
+        first=(_fetchone("SELECT MIN(day) FROM msg_counts") or (None,))[0]
+        _safe_alter("ALTER TABLE msg_counts PARTITION BY RANGE COLUMNS(day) (" + _msg_parts_sql(_msg_yms(min((first or ym)[:7], ym), nxt)) + ")")
+    # InnoDB 二级索引自带主键列，idx_day_cnt 实际是 (chat_id,day,cnt,user_id)，日/月聚合只扫它即可（Using index）。
+    # 旧的 idx_day 是它的前缀、idx_user 是主键的前缀，都只剩写放大，老库里有就删掉
+    for idx in ("idx_day","idx_user"):
+        if _fetchone("SELECT 1 FROM information_schema.STATISTICS WHERE TABLE_SCHEMA=DATABASE() AND TABLE_NAME='msg_counts' AND INDEX_NAME=%s LIMIT 1",(idx,)):
+            _safe_alter(f"ALTER TABLE msg_counts DROP INDEX {idx}")
     _exec("""CREATE TABLE IF NOT EXISTS scores (
         chat_id BIGINT NOT NULL, user_id BIGINT NOT NULL,
         username VARCHAR(64), first_name VARCHAR(64), last_name VARCHAR(64),
         points INT NOT NULL DEFAULT 0, last_checkin CHAR(10),
         is_bot TINYINT NOT NULL DEFAULT 0,
-        PRIMARY KEY (chat_id,user_id), KEY idx_points (chat_id,points)
+        PRIMARY KEY (chat_id,user_id), KEY idx_points_cover (chat_id,points,username,first_name,last_name), KEY idx_username (chat_id,username)
     ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci;""")
+    _safe_alter("ALTER TABLE scores ADD KEY idx_username (chat_id,username)")
+    # 积分榜 list_score_top 要的列（user_id 在主键里）全在索引上：倒序扫前 N 条即可，不回表；原地替换旧的 idx_points
+    _safe_alter("ALTER TABLE scores DROP INDEX idx_points, ADD KEY idx_points_cover (chat_id,points,username,first_name,last_name)")
     _exec("""CREATE TABLE IF NOT EXISTS score_logs (
         id BIGINT PRIMARY KEY AUTO_INCREMENT,
         chat_id BIGINT, actor_id BIGINT, target_id BIGINT,
@@ -279,14 +449,72 @@ def init_db():
         chat_id BIGINT NOT NULL,
         message_id BIGINT NOT NULL,
         expire_at VARCHAR(40) NOT NULL,
-        PRIMARY KEY(chat_id, message_id)
+        PRIMARY KEY(chat_id, message_id),
+        KEY idx_expire (expire_at)
     ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci;""")
+    _safe_alter("ALTER TABLE ephemeral_msgs ADD KEY idx_expire (expire_at)")
 
 # ====================== 状态/工具 ======================
+# 非 pending 键的读穿透缓存（库仍是权威，崩溃不丢）：调度线程每轮都要读 next_news_at、*_done:* 这类键。
+# 不存在的键也缓存成 None；pending:* 另有 _PENDING 索引，不进这里。
+# 只有读库的结果能进缓存，且读的过程中没有任何写（_STATE_GEN 未变）才放进去；写操作落库后直接作废该键，
+# 否则“读到旧值 → 别的线程写入 → 旧值进缓存”会让旧值一直留到重启
+_STATE_CACHE:"OrderedDict[str,Optional[str]]"=OrderedDict(); _STATE_CACHE_MAX=4096; _STATE_MISS=object()
+_STATE_LOCK=threading.Lock(); _STATE_GEN=0
+def _state_forget(key:str):
+    global _STATE_GEN
+    if key.startswith("pending:"): return
+    with _STATE_LOCK: _STATE_GEN+=1; _STATE_CACHE.pop(key,None)
 def state_get(key:str)->Optional[str]:
-    row=_fetchone("SELECT val FROM state WHERE `key`=%s",(key,)); return row[0] if row else None
-def state_set(key:str, val:str): _exec("INSERT INTO state(`key`,`val`) VALUES(%s,%s) ON DUPLICATE KEY UPDATE `val`=VALUES(`val`)",(key,val))
-def state_del(key:str): _exec("DELETE FROM state WHERE `key`=%s",(key,))
+    with _STATE_LOCK:
+        hit=_STATE_CACHE.get(key,_STATE_MISS); gen=_STATE_GEN
+    if hit is not _STATE_MISS: return hit
+    row=_fetchone("SELECT val FROM state WHERE `key`=%s",(key,)); val=row[0] if row else None
+    if not key.startswith("pending:"):
+        with _STATE_LOCK:
+            if gen==_STATE_GEN:
+                _STATE_CACHE[key]=val
+                if len(_STATE_CACHE)>_STATE_CACHE_MAX: _STATE_CACHE.popitem(last=False)
+    return val
+def state_set(key:str, val:str):
+    _exec("INSERT INTO state(`key`,`val`) VALUES(%s,%s) ON DUPLICATE KEY UPDATE `val`=VALUES(`val`)",(key,val))
+    _state_forget(key)
+    cu=_pending_owner(key)
+    if cu and cu in _PENDING: _PENDING[cu][key]=val
+def state_del(key:str):
+    cu=_pending_owner(key)
+    if _PENDING_EXP.pop(key,None) is None:
+        _exec("DELETE FROM state WHERE `key`=%s",(key,))
+    _state_forget(key)
+    if cu and cu in _PENDING: _PENDING[cu].pop(key,None)
+
+# pending:<kind>:<chat_id>:<uid> 的内存索引；每人首次访问时从库里整体加载一次，之后随 state_set/state_del 同步
+_PENDING:Dict[Tuple[int,int],Dict[str,str]]={}
+def _pending_owner(key:str)->Optional[Tuple[int,int]]:
+    if not key.startswith("pending:"): return None
+    try: _,c,u=key.rsplit(":",2); return int(c),int(u)
+    except ValueError: return None
+def pending_of(chat_id:int, uid:int)->Dict[str,str]:
+    cu=(chat_id,uid); pend=_PENDING.get(cu)
+    if pend is None:
+        if len(_PENDING)>50000:
+            for k,v in list(_PENDING.items()):  # 快照：更新 worker 并发写入
+                if not v: _PENDING.pop(k,None)
+        rows=_fetchall("SELECT `key`,`val` FROM state WHERE `key` LIKE %s",(f"pending:%:{chat_id}:{uid}",))
+        pend=_PENDING[cu]={k:v for k,v in rows if _pending_owner(k)==cu and k.split(":")[1] not in _PENDING_MEM_KINDS}
+    if _PENDING_EXP:
+        now=time.monotonic()
+        for k in [k for k in pend if _PENDING_EXP.get(k,now)<now]:
+            del pend[k]; del _PENDING_EXP[k]
+    return pend
+
+# 纯界面流程的“下一条消息是…”标记：只放内存，5 分钟过期，不落库（重启丢失无妨）
+_PENDING_MEM_KINDS=("set_ad_text","set_ad_media")
+_PENDING_TTL=300
+_PENDING_EXP:Dict[str,float]={}
+def pending_mark(chat_id:int, uid:int, kind:str):
+    key=f"pending:{kind}:{chat_id}:{uid}"
+    pending_of(chat_id, uid)[key]="1"; _PENDING_EXP[key]=time.monotonic()+_PENDING_TTL
 
 def clear_pending_states(chat_id:int, uid:int):
     for k in [
@@ -301,9 +529,19 @@ def clear_pending_states(chat_id:int, uid:int):
         try: state_del(k)
         except Exception: pass
 
-def news_enabled(chat_id:int)->bool:
-    v=state_get(f"news_enabled:{chat_id}"); return (v=="1") if v is not None else NEWS_ENABLED_DEFAULT
-def news_set_enabled(chat_id:int, enabled:bool): state_set(f"news_enabled:{chat_id}","1" if enabled else "0")
+_NEWS_FLAGS:Optional[Dict[int,bool]]=None  # news_enabled:<chat_id> 全量缓存，首次使用时一次性加载
+def _news_flags()->Dict[int,bool]:
+    global _NEWS_FLAGS
+    if _NEWS_FLAGS is None:
+        flags={}
+        for k,v in _fetchall("SELECT `key`,`val` FROM state WHERE `key` LIKE 'news\\_enabled:%%'",()):
+            try: flags[int(k.split(":",1)[1])]=(v=="1")
+            except ValueError: pass
+        _NEWS_FLAGS=flags
+    return _NEWS_FLAGS
+def news_enabled(chat_id:int)->bool: return _news_flags().get(chat_id, NEWS_ENABLED_DEFAULT)
+def news_set_enabled(chat_id:int, enabled:bool):
+    state_set(f"news_enabled:{chat_id}","1" if enabled else "0"); _news_flags()[chat_id]=enabled
 
 def add_ephemeral(chat_id:int, message_id:int, seconds:int):
     expire_at=(utcnow()+timedelta(seconds=max(5,seconds))).isoformat()
@@ -315,6 +553,9 @@ def send_ephemeral_html(chat_id:int, text:str, seconds:int, reply_markup:Optiona
         mid=int(((r or {}).get("result") or {}).get("message_id") or 0)
         if mid and seconds>0: add_ephemeral(chat_id, mid, seconds)
     except Exception: pass
+def popup_html(chat_id:int, text:str, seconds:int=POPUP_EPHEMERAL_SECONDS, **kw):
+    """按钮弹窗：排进该群的发送队列后立即返回，不阻塞下一条更新"""
+    outbox_put(chat_id, send_ephemeral_html, chat_id, text, seconds, **kw)
 def maybe_ephemeral_gc():
     now=utcnow().isoformat()
     rows=_fetchall("SELECT chat_id,message_id FROM ephemeral_msgs WHERE expire_at<=%s",(now,))
@@ -329,45 +570,164 @@ def _upsert_user_base(chat_id:int, frm:Dict):
           "VALUES (%s,%s,%s,%s,%s,%s,%s,%s) "
           "ON DUPLICATE KEY UPDATE username=VALUES(username), first_name=VALUES(first_name), last_name=VALUES(last_name), is_bot=VALUES(is_bot)",
           (chat_id, frm.get("id"), (frm.get("username") or "")[:64], (frm.get("first_name") or "")[:64], (frm.get("last_name") or "")[:64], 0, None, 1 if frm.get("is_bot") else 0))
-def _add_points(chat_id:int, target_id:int, delta:int, actor_id:int, reason:str=""):
-    _exec("INSERT INTO scores(chat_id,user_id,points) VALUES(%s,%s,%s) ON DUPLICATE KEY UPDATE points=points+VALUES(points)", (chat_id, target_id, delta))
-    _exec("INSERT INTO score_logs(chat_id,actor_id,target_id,delta,reason,ts) VALUES(%s,%s,%s,%s,%s,%s)", (chat_id, actor_id, target_id, delta, reason or "", utcnow().isoformat()))
+# 热点写语句集中成常量（PyMySQL 只做客户端插值，没有服务端 prepare）；加分+记日志共用一次取连接、一个游标。
+# 更新分支用 LAST_INSERT_ID(expr) 把新积分经 OK 包的 insert_id 带回来，调用方不必再 SELECT 一次
+_SQL_SCORE_ADD="INSERT INTO scores(chat_id,user_id,points) VALUES(%s,%s,%s) ON DUPLICATE KEY UPDATE points=LAST_INSERT_ID(points+VALUES(points))"
+_SQL_SCORE_LOG="INSERT INTO score_logs(chat_id,actor_id,target_id,delta,reason,ts) VALUES(%s,%s,%s,%s,%s,%s)"
+def _add_points(chat_id:int, target_id:int, delta:int, actor_id:int, reason:str="")->int:
+    """加分并记日志，返回变动后的积分"""
+    with db_conn() as conn, conn.cursor() as c:
+        c.execute(_SQL_SCORE_ADD, (chat_id, target_id, delta))
+        # 影响行数 1 = 新插入（积分即 delta）；2/0 = 更新（有无变化），新值在 insert_id 里（无符号 64 位，负分要折回）
+        pts=delta if c.rowcount==1 else int(c.lastrowid or 0)
+        if pts>=1<<63: pts-=1<<64
+        c.execute(_SQL_SCORE_LOG, (chat_id, actor_id, target_id, delta, reason or "", utcnow().isoformat()))
+    _lb_forget(chat_id); return pts
+def bulk_upsert_scores(chat_id:int, rows:List[Tuple[int,str,str,str,int,str]]):
+    """批量发奖：[(uid,un,fn,ln,delta,reason)] 一条多值 upsert + 一条批量日志，单事务提交"""
+    if not rows: return
+    ts=utcnow().isoformat()
+    with db_conn() as conn:
+        conn.begin()
+        try:
+            with conn.cursor() as c:
+                c.executemany("INSERT INTO scores(chat_id,user_id,username,first_name,last_name,points) VALUES (%s,%s,%s,%s,%s,%s) "
+                              "ON DUPLICATE KEY UPDATE points=points+VALUES(points), username=VALUES(username), first_name=VALUES(first_name), last_name=VALUES(last_name)",
+                              [(chat_id, uid, (un or "")[:64], (fn or "")[:64], (ln or "")[:64], delta) for uid,un,fn,ln,delta,_r in rows])
+                c.executemany(_SQL_SCORE_LOG,
+                              [(chat_id, uid, uid, delta, reason or "", ts) for uid,_u,_f,_l,delta,reason in rows])
+            conn.commit()
+        except Exception:
+            conn.rollback(); raise
+    _lb_forget(chat_id)
 def _get_points(chat_id:int, user_id:int)->int:
     row=_fetchone("SELECT points FROM scores WHERE chat_id=%s AND user_id=%s",(chat_id,user_id)); return int(row[0]) if row else 0
 def _get_last_checkin(chat_id:int, user_id:int)->str:
     row=_fetchone("SELECT last_checkin FROM scores WHERE chat_id=%s AND user_id=%s",(chat_id,user_id)); return row[0] or "" if row else ""
 def _set_last_checkin(chat_id:int, user_id:int, day:str): _exec("UPDATE scores SET last_checkin=%s WHERE chat_id=%s AND user_id=%s",(day,chat_id,user_id))
+# 发言计数走写缓冲：同一 (chat, user, day) 的多次 +1 在内存里合并，后台线程每 MSG_FLUSH_SECONDS 秒（或攒满 MSG_FLUSH_MAX_KEYS 键被提前唤醒）批量落库
+_MSG_BUF:Dict[Tuple[int,int,str],Tuple[int,Dict]]={}; _MSG_BUF_LOCK=threading.Lock()
+_MSG_FLUSH_INTERVAL=max(0.5, MSG_FLUSH_SECONDS); _MSG_BUF_MAX=max(1, MSG_FLUSH_MAX_KEYS); _MSG_FLUSHER:Optional[threading.Thread]=None
+_MSG_FLUSH_NOW=threading.Event()
+# 整批写失败的键下一轮逐条重写，把坏行（超长、分区外的 day 等）隔离出来；同一键连续失败 _MSG_MAX_TRIES 次就丢弃，断线不计次
+_MSG_FAILS:Dict[Tuple[int,int,str],int]={}; _MSG_MAX_TRIES=3
 def inc_msg_count(chat_id:int, frm:Dict, day:str, inc:int=1):
-    _upsert_user_base(chat_id, frm)
-    _exec("INSERT INTO msg_counts(chat_id,user_id,username,first_name,last_name,day,cnt) "
-          "VALUES (%s,%s,%s,%s,%s,%s,%s) "
-          "ON DUPLICATE KEY UPDATE cnt=cnt+VALUES(cnt), username=VALUES(username), first_name=VALUES(first_name), last_name=VALUES(last_name)",
-          (chat_id, frm.get("id"), (frm.get("username") or "")[:64], (frm.get("first_name") or "")[:64], (frm.get("last_name") or "")[:64], day, inc))
-
-def list_chat_admin_ids(chat_id:int)->set:
-    key=f"admins:{chat_id}"; now=int(time.time()); cached=state_get(key)
+    global _MSG_FLUSHER
+    key=(chat_id, frm.get("id"), day)
+    _remember_name(chat_id, frm.get("id"), (frm.get("username") or "", frm.get("first_name") or "", frm.get("last_name") or ""))
+    with _MSG_BUF_LOCK:
+        prev=_MSG_BUF.get(key)
+        _MSG_BUF[key]=((prev[0] if prev else 0)+inc, frm)
+        full=len(_MSG_BUF)>=_MSG_BUF_MAX
+        if _MSG_FLUSHER is None:
+            _MSG_FLUSHER=threading.Thread(target=_msg_flush_loop, name="msg-flush", daemon=True); _MSG_FLUSHER.start()
+    if full: _MSG_FLUSH_NOW.set()  # 只唤醒落库线程：更新 worker 不碰库，写失败也不影响本条消息的处理
+def _msg_flush_loop():
+    while True:
+        _MSG_FLUSH_NOW.wait(_MSG_FLUSH_INTERVAL); _MSG_FLUSH_NOW.clear()
+        try: flush_msg_counts()
+        except Exception: logger.exception("msg count flush error")
+def _db_conn_lost(e:Exception)->bool:
+    return isinstance(e,_MySQLOperationalError) and bool(e.args) and e.args[0] in (2003,2006,2013)
+def _msg_write(c, items:Dict):
+    def names(f:Dict): return (f.get("username") or "")[:64], (f.get("first_name") or "")[:64], (f.get("last_name") or "")[:64]
+    users={(cid,uid):frm for (cid,uid,_d),(_c,frm) in items.items()}
+    # VALUES 里只能是占位符，pymysql 才会把 executemany 拼成一条多行 INSERT；points/last_checkin 走列默认值
+    c.executemany("INSERT INTO scores(chat_id,user_id,username,first_name,last_name,is_bot) "
+                  "VALUES (%s,%s,%s,%s,%s,%s) "
+                  "ON DUPLICATE KEY UPDATE username=VALUES(username), first_name=VALUES(first_name), last_name=VALUES(last_name), is_bot=VALUES(is_bot)",
+                  [(cid,uid,*names(frm),1 if frm.get("is_bot") else 0) for (cid,uid),frm in users.items()])
+    c.executemany("INSERT INTO msg_counts(chat_id,user_id,username,first_name,last_name,day,cnt) "
+                  "VALUES (%s,%s,%s,%s,%s,%s,%s) "
+                  "ON DUPLICATE KEY UPDATE cnt=cnt+VALUES(cnt), username=VALUES(username), first_name=VALUES(first_name), last_name=VALUES(last_name)",
+                  [(cid,uid,*names(frm),day,cnt) for (cid,uid,day),(cnt,frm) in items.items()])
+def _msg_requeue(items:Dict, fails:Dict):
+    """没写进去的计数并回缓冲（和这期间新来的累加），记下失败次数；满次数的丢弃"""
+    with _MSG_BUF_LOCK:
+        for k,(cnt,frm) in items.items():
+            if fails[k]>=_MSG_MAX_TRIES: _MSG_FAILS.pop(k,None); continue
+            prev=_MSG_BUF.get(k); _MSG_BUF[k]=(cnt+(prev[0] if prev else 0), prev[1] if prev else frm)
+            _MSG_FAILS[k]=fails[k]
+def flush_msg_counts():
+    """不抛异常：写失败的计数回到缓冲等下一轮"""
+    with _MSG_BUF_LOCK:
+        if not _MSG_BUF: return
+        buf=dict(_MSG_BUF); _MSG_BUF.clear()
+        retry={k:_MSG_FAILS.pop(k) for k in buf if k in _MSG_FAILS}
+    fresh={k:v for k,v in buf.items() if k not in retry}
+    if fresh:
+        try:
+            with db_conn() as conn, conn.cursor() as c: _msg_write(c, fresh)
+        except Exception:
+            logger.exception("msg count flush error"); _msg_requeue(fresh, {k:0 for k in fresh})
+    if not retry: return
+    left={k:buf[k] for k in retry}
+    try:
+        with db_conn() as conn, conn.cursor() as c:
+            for k,v in list(left.items()):
+                try: _msg_write(c, {k:v}); left.pop(k)
+                except Exception as e:
+                    if _db_conn_lost(e): raise
+                    retry[k]+=1
+                    if retry[k]>=_MSG_MAX_TRIES: log(logging.ERROR,"msg count dropped",chat_id=k[0],error=f"{k} cnt={v[0]} {e}")
+    except Exception as e:
+        if not _db_conn_lost(e): logger.exception("msg count flush error")
+    _msg_requeue(left, retry)
+atexit.register(flush_msg_counts)
+
+# 进程内先挡一层（同样 600 秒有效期，按写入库时的 ts 计），命中时不再查 state 表、不再解 JSON
+_ADMIN_IDS_CACHE:Dict[int,Tuple[int,frozenset]]={}
+def list_chat_admin_ids(chat_id:int)->frozenset:
+    """只读集合（调用方只做 in 判断），直接返回缓存里的 frozenset，不再每次复制"""
+    now=int(time.time()); hit=_ADMIN_IDS_CACHE.get(chat_id)
+    if hit and now-hit[0]<600: return hit[1]
+    key=f"admins:{chat_id}"; cached=state_get(key)
     if cached:
         try:
-            data=json.loads(cached)
-            if now-int(data.get("ts",0))<600: return set(data.get("ids",[]))
+            data=json.loads(cached); ts=int(data.get("ts",0))
+            if now-ts<600:
+                ids=frozenset(data.get("ids",[])); _ADMIN_IDS_CACHE[chat_id]=(ts,ids); return ids
         except Exception: pass
     ids=set(); r=http_get("getChatAdministrators", params={"chat_id":chat_id})
     if r and r.get("ok"):
         for m in r["result"]:
             u=m.get("user") or {}
             if "id" in u: ids.add(u["id"])
-    state_set(key, json.dumps({"ids":list(ids),"ts":now})); return ids
-
-def ensure_user_display(chat_id:int, uid:int, triplet:Tuple[str,str,str]):
-    un,fn,ln=triplet
-    if un or fn or ln: return un,fn,ln
+    ids=frozenset(ids); state_set(key, json.dumps({"ids":list(ids),"ts":now})); _ADMIN_IDS_CACHE[chat_id]=(now,ids); return ids
+def admin_list_forget(chat_id:int):
+    _ADMIN_IDS_CACHE.pop(chat_id,None); state_del(f"admins:{chat_id}")
+
+# 收消息/处理命令时见过的 (chat, uid) -> (username, first, last)；报表里库中名字为空的行先查这里，再去 getChatMember
+_USER_NAME_CACHE:"OrderedDict[Tuple[int,int],Tuple[str,str,str]]"=OrderedDict(); _USER_NAME_MAX=20000
+def _remember_name(chat_id:int, uid:Optional[int], triplet:Tuple[str,str,str]):
+    if not uid or not any(triplet): return
+    _USER_NAME_CACHE[(chat_id,uid)]=triplet
+    if len(_USER_NAME_CACHE)>_USER_NAME_MAX: _USER_NAME_CACHE.popitem(last=False)
+def _fetch_member_name(chat_id:int, uid:int)->Tuple[str,str,str]:
     r=http_get("getChatMember", params={"chat_id":chat_id,"user_id":uid})
     user=((r or {}).get("result") or {}).get("user") or {}
-    un2=user.get("username") or ""; fn2=user.get("first_name") or ""; ln2=user.get("last_name") or ""
-    if un2 or fn2 or ln2:
-        _exec("UPDATE scores SET username=%s, first_name=%s, last_name=%s WHERE chat_id=%s AND user_id=%s",(un2,fn2,ln2,chat_id,uid))
-        return un2,fn2,ln2
+    return user.get("username") or "", user.get("first_name") or "", user.get("last_name") or ""
+def ensure_user_display(chat_id:int, uid:int, triplet:Tuple[str,str,str]):
+    un,fn,ln=triplet
+    if un or fn or ln: _remember_name(chat_id, uid, triplet); return un,fn,ln
+    hit=_USER_NAME_CACHE.get((chat_id,uid))
+    if hit: return hit
+    got=_fetch_member_name(chat_id, uid)
+    if any(got):
+        _exec("UPDATE scores SET username=%s, first_name=%s, last_name=%s WHERE chat_id=%s AND user_id=%s",(*got,chat_id,uid))
+        _remember_name(chat_id, uid, got); return got
     return un,fn,ln
+def warm_user_names(chat_id:int, rows):
+    """报表渲染前批量补名字：rows 为 (uid,un,fn,ln,...)；缓存未命中的并发 getChatMember，结果一次 executemany 回写"""
+    misses=list({r[0] for r in rows if not (r[1] or r[2] or r[3]) and (chat_id,r[0]) not in _USER_NAME_CACHE})
+    if not misses: return
+    with ThreadPoolExecutor(max_workers=min(8,len(misses))) as ex:
+        got=[(uid,t) for uid,t in zip(misses, ex.map(lambda uid: _fetch_member_name(chat_id, uid), misses)) if any(t)]
+    if not got: return
+    for uid,t in got: _remember_name(chat_id, uid, t)
+    with db_conn() as conn, conn.cursor() as c:
+        c.executemany("UPDATE scores SET username=%s, first_name=%s, last_name=%s WHERE chat_id=%s AND user_id=%s",
+                      [(*t,chat_id,uid) for uid,t in got])
 
 def _user_link(uid:Optional[int], username:Optional[str])->str:
     username=(username or "").strip()
@@ -392,7 +752,12 @@ def fetch_og_image(article_url:str)->Optional[str]:
     return None
 
 # ====================== 广告（存取 & 发送） ======================
+_AD_CACHE:Dict[int,tuple]={}  # 写操作一律清掉对应 chat 的缓存，下次读再回源
 def ad_get(chat_id:int):
+    hit=_AD_CACHE.get(chat_id)
+    if hit is None: hit=_AD_CACHE[chat_id]=_ad_load(chat_id)
+    return hit
+def _ad_load(chat_id:int):
     row=_fetchone("SELECT enabled, content, COALESCE(mode,'attach'), COALESCE(times,''), COALESCE(media_type,'none'), COALESCE(file_id,'') FROM ads WHERE chat_id=%s",(chat_id,))
     if row:
         en,ct,mode,times,mt,fid = int(row[0])==1, row[1] or "", row[2] or "attach", row[3] or "", row[4] or "none", row[5] or ""
@@ -401,33 +766,59 @@ def ad_get(chat_id:int):
           (chat_id,1 if AD_DEFAULT_ENABLED else 0,"","attach","", "none","", utcnow().isoformat()))
     return AD_DEFAULT_ENABLED,"","attach","", "none",""
 def ad_set(chat_id:int, content:str):
+    ad_flush(chat_id)
     _exec("INSERT INTO ads(chat_id,enabled,content,updated_at) VALUES(%s,%s,%s,%s) "
           "ON DUPLICATE KEY UPDATE content=VALUES(content), updated_at=VALUES(updated_at)",
           (chat_id,1 if AD_DEFAULT_ENABLED else 0,content,utcnow().isoformat()))
+    _AD_CACHE.pop(chat_id,None)
+# 按钮上的开关/模式/清空先改内存（_AD_CACHE 同步更新，读到的就是新值），
+# 每轮更新处理完由 ad_flush 合并成每群一条 UPDATE；其它写操作动手前先 flush 本群，保证先后顺序
+_AD_COLS=("enabled","content","mode","times","media_type","file_id")
+_AD_DIRTY:Dict[int,Dict[str,object]]={}
+def _ad_stage(chat_id:int, **cols):
+    cur=dict(zip(_AD_COLS, ad_get(chat_id)))  # ad_get 保证行已存在
+    cur.update(cols)
+    _AD_CACHE[chat_id]=tuple(cur[c] for c in _AD_COLS)
+    _AD_DIRTY.setdefault(chat_id,{}).update(cols)
+def ad_flush(chat_id:Optional[int]=None):
+    """写失败时把列并回 _AD_DIRTY（期间新改的列优先），下一轮重试；_AD_CACHE 仍是暂存后的值。
+    指定 chat_id 的是其它写操作前的先行 flush：失败要抛出，不能让后面的写越过还没落库的旧改动"""
+    for cid in ([chat_id] if chat_id is not None else list(_AD_DIRTY)):
+        cols=_AD_DIRTY.pop(cid,None)
+        if not cols: continue
+        vals=[(1 if v else 0) if k=="enabled" else v for k,v in cols.items()]
+        try:
+            _exec("UPDATE ads SET "+", ".join(f"{k}=%s" for k in cols)+", updated_at=%s WHERE chat_id=%s",
+                  (*vals, utcnow().isoformat(), cid))
+        except Exception:
+            cols.update(_AD_DIRTY.get(cid,{})); _AD_DIRTY[cid]=cols
+            if chat_id is not None: raise
+            logger.exception("ad flush error", extra={"chat_id":cid})
+atexit.register(ad_flush)
 def ad_enable(chat_id:int, enabled:bool):
-    _exec("INSERT INTO ads(chat_id,enabled,updated_at) VALUES(%s,%s,%s) "
-          "ON DUPLICATE KEY UPDATE enabled=VALUES(enabled), updated_at=VALUES(updated_at)",
-          (chat_id,1 if enabled else 0,utcnow().isoformat()))
+    _ad_stage(chat_id, enabled=bool(enabled))
 def ad_clear(chat_id:int):
-    _exec("UPDATE ads SET content=%s, media_type='none', file_id='', updated_at=%s WHERE chat_id=%s",("", utcnow().isoformat(), chat_id))
+    _ad_stage(chat_id, content="", media_type="none", file_id="")
 def ad_set_mode(chat_id:int, mode:str):
     if mode not in ("attach","schedule","disabled"): return
-    _exec("UPDATE ads SET mode=%s, enabled=%s, updated_at=%s WHERE chat_id=%s",(mode, 0 if mode=="disabled" else 1, utcnow().isoformat(), chat_id))
+    _ad_stage(chat_id, mode=mode, enabled=mode!="disabled")
 def _norm_times_str(times:str)->str:
     lst=[]
-    for p in re.split(r"[,\s]+", times or ""):
+    for p in _LIST_SEP_RE.split(times or ""):
         if not p: continue
-        m=re.match(r"^(\d{1,2}):(\d{2})$",p); 
+        m=_HHMM_RE.match(p); 
         if not m: continue
         h,mi=int(m.group(1)),int(m.group(2))
         if 0<=h<=23 and 0<=mi<=59: lst.append(f"{h:02d}:{mi:02d}")
     return ",".join(sorted(set(lst)))
 def ad_set_times(chat_id:int, times:str):
-    t=_norm_times_str(times)
-    _exec("UPDATE ads SET times=%s, updated_at=%s WHERE chat_id=%s",(t, utcnow().isoformat(), chat_id)); return t
+    t=_norm_times_str(times); ad_flush(chat_id)
+    _exec("UPDATE ads SET times=%s, updated_at=%s WHERE chat_id=%s",(t, utcnow().isoformat(), chat_id)); _AD_CACHE.pop(chat_id,None); return t
 def ad_set_media(chat_id:int, media_type:str, file_id:str, content:str):
     if media_type not in ("photo","video"): return
+    ad_flush(chat_id)
     _exec("UPDATE ads SET media_type=%s, file_id=%s, content=%s, updated_at=%s WHERE chat_id=%s",(media_type,file_id,content or "", utcnow().isoformat(), chat_id))
+    _AD_CACHE.pop(chat_id,None)
 def ad_send_now(chat_id:int, preview_only:bool=False):
     en,ct,mode,times,mt,fid=ad_get(chat_id)
     if not ct.strip() and (mt=="none" or not fid):
@@ -475,32 +866,32 @@ def ad_timepicker_open(chat_id:int, uid:int):
         send_ephemeral_html(chat_id, "仅管理员可设置。", POPUP_EPHEMERAL_SECONDS); return
     st=_adtime_load(chat_id, uid); _adtime_save(chat_id, uid, st)
     send_ephemeral_html(chat_id, _adtime_txt(st), POPUP_EPHEMERAL_SECONDS, reply_markup=_adtime_kb(st))
-def ad_timepicker_handle(chat_id:int, uid:int, message_id:int, data_s:str, cb_id:str):
+def ad_timepicker_handle(chat_id:int, uid:int, message_id:int, op:str, arg:str, cb_id:str):
+    """op/arg 由回调分发处从 "AT_<op>[:<arg>]" 拆好传入"""
     if not is_chat_admin(chat_id, uid): return
     st=_adtime_load(chat_id, uid)
-    if data_s.startswith("AT_H:"):
-        h=int(data_s.split(":")[1]); st["hold"]=h
-    elif data_s.startswith("AT_M:"):
-        m=int(data_s.split(":")[1]); h=st.get("hold")
+    if op=="H":
+        st["hold"]=int(arg)
+    elif op=="M":
+        m=int(arg); h=st.get("hold")
         if h is not None:
             st["sel"]=sorted(set((st.get("sel") or []) + [f"{int(h):02d}:{int(m):02d}"]))
             st["hold"]=None
-    elif data_s.startswith("AT_Q:"):
-        v=data_s.split(":",1)[1]
-        st["sel"]=sorted(set((st.get("sel") or []) + [v])); st["hold"]=None
-    elif data_s.startswith("AT_HPG:"):
-        st["hpage"]=int(data_s.split(":")[1])%2
-    elif data_s.startswith("AT_MPG:"):
-        st["mpage"]=int(data_s.split(":")[1])%2
-    elif data_s=="AT_CLEAR":
+    elif op=="Q":
+        st["sel"]=sorted(set((st.get("sel") or []) + [arg])); st["hold"]=None
+    elif op=="HPG":
+        st["hpage"]=int(arg)%2
+    elif op=="MPG":
+        st["mpage"]=int(arg)%2
+    elif op=="CLEAR":
         st["sel"]=[]; st["hold"]=None
-    elif data_s=="AT_SAVE":
+    elif op=="SAVE":
         times=",".join(st.get("sel") or [])
         ad_set_times(chat_id, times)
         state_del(_adtime_state_key(chat_id, uid))
         edit_message_html(chat_id, message_id, f"🕒 已保存广告发送时间：\n<b>{safe_html(times or '（空）')}</b>")
         return
-    elif data_s=="AT_CLOSE":
+    elif op=="CLOSE":
         state_del(_adtime_state_key(chat_id, uid)); edit_message_html(chat_id, message_id, "已关闭设置。"); return
     _adtime_save(chat_id, uid, st)
     edit_message_html(chat_id, message_id, _adtime_txt(st), reply_markup=_adtime_kb(st))
@@ -541,52 +932,70 @@ def build_rules_text(chat_id:int)->str:
 
 # ====================== 兑换 U ======================
 TRX_ADDR_RE=re.compile(r"^T[1-9A-HJ-NP-Za-km-z]{33}$")
+# 审批按钮都是本进程发出的：发出时记下 (chat_id, user_id, u_amount)，审批时省掉一次 SELECT；
+# 是否仍待处理由 UPDATE ... AND status='pending' 的影响行数把关，缓存只替代读取
+_REDEEM_CACHE:Dict[int,Tuple[int,int,int,float]]={}  # rid -> (chat_id, user_id, u_amount, 缓存时刻)
+_REDEEM_TTL=7*86400
 def redeem_create(chat_id:int, uid:int, u_amount:int, addr:str):
     row=_fetchone("SELECT username,first_name,last_name,points FROM scores WHERE chat_id=%s AND user_id=%s",(chat_id,uid))
     username,fn,ln,pts=(row or ("","","",0))
-    _exec("""INSERT INTO redemptions(chat_id,user_id,username,first_name,last_name,points_snapshot,u_amount,trc20_addr,status,created_at)
-             VALUES(%s,%s,%s,%s,%s,%s,%s,%s,'pending',%s)""",(chat_id,uid,username,fn,ln,int(pts or 0),u_amount,addr,utcnow().isoformat()))
-    rid=_fetchone("SELECT LAST_INSERT_ID()",())[0]; return int(rid)
+    # 自增 id 取本次 INSERT 所在连接的 lastrowid：连接池里另取一条连接 SELECT LAST_INSERT_ID() 会拿到别人的 id
+    rid=int(_exec("""INSERT INTO redemptions(chat_id,user_id,username,first_name,last_name,points_snapshot,u_amount,trc20_addr,status,created_at)
+             VALUES(%s,%s,%s,%s,%s,%s,%s,%s,'pending',%s)""",(chat_id,uid,username,fn,ln,int(pts or 0),u_amount,addr,utcnow().isoformat())).lastrowid)
+    now=time.monotonic()
+    if len(_REDEEM_CACHE)>1000:
+        for k,v in list(_REDEEM_CACHE.items()):
+            if now-v[3]>=_REDEEM_TTL: _REDEEM_CACHE.pop(k,None)
+    _REDEEM_CACHE[rid]=(chat_id,uid,int(u_amount),now)
+    return rid
 
 def redeem_broadcast_success(chat_id:int, uid:int, u_amount:int):
     un,fn,ln=ensure_user_display(chat_id, uid, ("","",""))
     full=(f"{fn or ''} {ln or ''}").strip() or (f"@{un}" if un else f"ID:{uid}")
     send_message_html(chat_id, f"🎉 恭喜“{safe_html(full)}”兑换成功\n兑换金额：<b>{u_amount} U</b>")
 
+def _redeem_status(chat_id:int, rid:int)->Optional[str]:
+    row=_fetchone("SELECT status FROM redemptions WHERE id=%s AND chat_id=%s",(rid,chat_id))
+    return (row[0] or "").lower() if row else None
+
 def admin_redeem_decide(chat_id: int, rid: int, approve: bool, admin_id: int):
-    row = _fetchone(
-        "SELECT id, user_id, u_amount, status FROM redemptions WHERE id=%s AND chat_id=%s",
-        (rid, chat_id),
-    )
-    if not row:
-        send_ephemeral_html(chat_id, f"未找到兑换申请 #{rid}", POPUP_EPHEMERAL_SECONDS)
-        return
-    _, user_id, u_amount, status = row
-    status = (status or "").lower()
-    if status != "pending":
-        send_ephemeral_html(chat_id, f"兑换申请 #{rid} 已处理（{status}）。", POPUP_EPHEMERAL_SECONDS)
+    hit = _REDEEM_CACHE.pop(rid, None)
+    if hit and hit[0] == chat_id and time.monotonic() - hit[3] < _REDEEM_TTL:
+        user_id, u_amount = hit[1], hit[2]
+    else:
+        row = _fetchone(
+            "SELECT id, user_id, u_amount, status FROM redemptions WHERE id=%s AND chat_id=%s",
+            (rid, chat_id),
+        )
+        if not row:
+            send_ephemeral_html(chat_id, f"未找到兑换申请 #{rid}", POPUP_EPHEMERAL_SECONDS)
+            return
+        _, user_id, u_amount, status = row
+        status = (status or "").lower()
+        if status != "pending":
+            send_ephemeral_html(chat_id, f"兑换申请 #{rid} 已处理（{status}）。", POPUP_EPHEMERAL_SECONDS)
+            return
+    # 先抢占状态再动积分：并发/重复点击时只有一次能把 pending 改掉
+    claimed = _exec(
+        "UPDATE redemptions SET status=%s, decided_by=%s, decided_at=%s WHERE id=%s AND chat_id=%s AND status='pending'",
+        ("approved" if approve else "rejected", admin_id, utcnow().isoformat(), rid, chat_id),
+    ).rowcount
+    if not claimed:
+        status = _redeem_status(chat_id, rid)
+        send_ephemeral_html(chat_id, f"兑换申请 #{rid} 已处理（{status}）。" if status else f"未找到兑换申请 #{rid}", POPUP_EPHEMERAL_SECONDS)
         return
     if approve:
         need_pts = int(u_amount) * REDEEM_RATE
         cur_pts = _get_points(chat_id, int(user_id))
-        deduct = min(cur_pts, need_pts)
+        deduct = min(cur_pts, need_pts); new_pts = cur_pts
         if deduct > 0:
-            _add_points(chat_id, int(user_id), -deduct, int(admin_id), "redeem_approve")
-        _exec(
-            "UPDATE redemptions SET status='approved', decided_by=%s, decided_at=%s WHERE id=%s",
-            (admin_id, utcnow().isoformat(), rid),
-        )
+            new_pts = _add_points(chat_id, int(user_id), -deduct, int(admin_id), "redeem_approve")
         redeem_broadcast_success(chat_id, int(user_id), int(u_amount))
-        new_pts = _get_points(chat_id, int(user_id))
         send_message_html(
             chat_id,
             f"✅ 兑换申请 #{rid} 已批准\n扣除积分：<b>{deduct}</b>（需求 {need_pts}）\n当前余额：<b>{new_pts}</b>",
         )
     else:
-        _exec(
-            "UPDATE redemptions SET status='rejected', decided_by=%s, decided_at=%s WHERE id=%s",
-            (admin_id, utcnow().isoformat(), rid),
-        )
         send_message_html(chat_id, f"❌ 兑换申请 #{rid} 已拒绝。")
 
 # ====================== 邀请绑定/新人欢迎 ======================
@@ -594,25 +1003,27 @@ def _bind_invite_if_needed(chat_id:int, new_member:Dict, inviter:Dict):
     try:
         invitee_id=(new_member or {}).get("id"); inviter_id=(inviter or {}).get("id")
         if not invitee_id or not inviter_id or invitee_id==inviter_id: return
-        existed=_fetchone("SELECT 1 FROM invites WHERE chat_id=%s AND invitee_id=%s",(chat_id,invitee_id))
-        if existed: return
-        _exec("INSERT INTO invites(chat_id, invitee_id, inviter_id, ts) VALUES(%s,%s,%s,%s)",(chat_id,invitee_id,inviter_id,utcnow().isoformat()))
+        # 主键 (chat_id, invitee_id) 兜底：INSERT IGNORE 一步完成查重+写入，影响 0 行即已绑定过（并发入群也只奖励一次）
+        if not _exec("INSERT IGNORE INTO invites(chat_id, invitee_id, inviter_id, ts) VALUES(%s,%s,%s,%s)",
+                     (chat_id,invitee_id,inviter_id,utcnow().isoformat())).rowcount: return
         _add_points(chat_id, inviter_id, INVITE_REWARD_POINTS, inviter_id, "invite_new_member")
     except Exception: logger.exception("bind_invite error", extra={"chat_id":chat_id})
 
 def handle_new_members(msg:Dict):
     chat_id=(msg.get("chat") or {}).get("id"); inviter=msg.get("from") or {}; members=msg.get("new_chat_members") or []
     for m in members:
+        if (m or {}).get("id"): admin_cache_forget(chat_id, m["id"])
         _upsert_user_base(chat_id, m or {})
         if inviter and inviter.get("id") and inviter.get("id")!=(m or {}).get("id"):
             _bind_invite_if_needed(chat_id, m, inviter)
     if WELCOME_PANEL_ENABLED and members:
-        send_ephemeral_html(chat_id, build_rules_text(chat_id), WELCOME_EPHEMERAL_SECONDS, reply_markup=build_menu(is_admin_user=False, chat_id=chat_id))
+        send_ephemeral_html(chat_id, build_rules_text(chat_id), WELCOME_EPHEMERAL_SECONDS, reply_markup=build_menu_json(is_admin_user=False, chat_id=chat_id))
 
 def handle_left_member(msg:Dict):
     chat_id=(msg.get("chat") or {}).get("id"); left=msg.get("left_chat_member") or {}
     invitee_id=left.get("id"); 
     if not invitee_id: return
+    admin_cache_forget(chat_id, invitee_id)
     row=_fetchone("SELECT inviter_id FROM invites WHERE chat_id=%s AND invitee_id=%s",(chat_id,invitee_id))
     if not row: return
     inviter_id=row[0]; _add_points(chat_id, inviter_id, -INVITE_REWARD_POINTS, inviter_id, "invite_auto_leave")
@@ -622,17 +1033,36 @@ def handle_left_member(msg:Dict):
 def ikb(text:str,data:str)->dict: return {"text":text,"callback_data":data}
 def urlb(text:str,url:str)->dict: return {"text":text,"url":url}
 
-def is_chat_admin(chat_id:int, uid:Optional[int])->bool:
-    if not uid: return False
+def _is_chat_admin(chat_id:int, uid:int)->bool:
     if uid in ADMIN_USER_IDS: return True
     if uid in list_chat_admin_ids(chat_id): return True
+    # 列表最多缓存 10 分钟，刚被设为管理员的人不在里面：没命中仍以 getChatMember 为准
     r=http_get("getChatMember", params={"chat_id":chat_id,"user_id":uid})
     try:
         status=((r or {}).get("result") or {}).get("status","")
-        return status in ("administrator","creator")
+        ok=status in ("administrator","creator")
     except Exception:
         return False
+    if ok: admin_list_forget(chat_id)  # 列表已过时，下次重新拉取
+    return ok
 
+# 命令和按钮几乎每个管理分支都要鉴权；同一 (chat, uid) 复用结果：是管理员记 300 秒，不是只记 30 秒（刚被提拔的人很快能用上），
+# 成员进出群时清掉对应条目。条目满 _ADMIN_CACHE_MAX 时先扫掉过期的，仍满则按插入顺序丢最老的
+_ADMIN_CACHE:Dict[Tuple[int,int],Tuple[bool,float]]={}; _ADMIN_CACHE_TTL=300; _ADMIN_CACHE_NEG_TTL=30; _ADMIN_CACHE_MAX=4096
+def _admin_cache_ttl(ok:bool)->int: return _ADMIN_CACHE_TTL if ok else _ADMIN_CACHE_NEG_TTL
+def is_chat_admin(chat_id:int, uid:Optional[int])->bool:
+    if not uid: return False
+    hit=_ADMIN_CACHE.get((chat_id,uid)); now=time.monotonic()
+    if hit and now-hit[1]<_admin_cache_ttl(hit[0]): return hit[0]
+    ok=_is_chat_admin(chat_id, uid)
+    if len(_ADMIN_CACHE)>=_ADMIN_CACHE_MAX:
+        for k,v in list(_ADMIN_CACHE.items()):  # 快照：更新 worker 并发写入
+            if now-v[1]>=_admin_cache_ttl(v[0]): _ADMIN_CACHE.pop(k,None)
+        for k in list(_ADMIN_CACHE)[:len(_ADMIN_CACHE)-_ADMIN_CACHE_MAX+1]: _ADMIN_CACHE.pop(k,None)
+    _ADMIN_CACHE[(chat_id,uid)]=(ok,now); return ok
+def admin_cache_forget(chat_id:int, uid:int): _ADMIN_CACHE.pop((chat_id,uid),None)
+
+@lru_cache(maxsize=1)
 def get_biz_buttons()->List[dict]:
     btns=[]; raw=(BIZ_LINKS or "").strip()
     if raw:
@@ -646,6 +1076,17 @@ def get_biz_buttons()->List[dict]:
     return btns
 
 def build_menu(is_admin_user:bool, chat_id:Optional[int]=None)->dict:
+    admin=chat_id is not None and is_admin_user
+    return _build_menu_cached(admin, news_enabled(chat_id) if admin else False)
+def build_menu_json(is_admin_user:bool, chat_id:Optional[int]=None)->str:
+    admin=chat_id is not None and is_admin_user
+    return _menu_json_cached(admin, news_enabled(chat_id) if admin else False)
+@lru_cache(maxsize=8)
+def _menu_json_cached(is_admin:bool, news_on:bool)->str: return _jdumps(_build_menu_cached(is_admin, news_on))
+
+@lru_cache(maxsize=8)
+def _build_menu_cached(is_admin:bool, news_on:bool)->dict:
+    """菜单只取决于（是否管理员, 新闻开关）；招商按钮来自启动时的环境变量。返回的 dict 为共享对象，勿修改"""
     kb=[
         [ikb("✅ 签到","ACT_CHECKIN")],
         [ikb("📌 我的积分","ACT_SCORE"), ikb("🏆 积分榜Top10","ACT_TOP10")],
@@ -655,7 +1096,7 @@ def build_menu(is_admin_user:bool, chat_id:Optional[int]=None)->dict:
         [ikb("🆘 帮助","ACT_HELP")],
     ]
     # 管理专属
-    if chat_id is not None and is_admin_user:
+    if is_admin:
         kb.append([ikb("🛠 积分管理","ACT_SCORE_MGR")])
         # 如需开放自定义新闻，可在回调里处理 ACT_CNEWS_PANEL
         # kb.append([ikb("📰 自定义新闻","ACT_CNEWS_PANEL")])
@@ -664,7 +1105,7 @@ def build_menu(is_admin_user:bool, chat_id:Optional[int]=None)->dict:
         kb.append([ikb("🕒 设置时间点","ACT_AD_SET_TIMES"), ikb("🖼 设置图文广告","ACT_AD_SET_MEDIA"), ikb("🔍 预览广告","ACT_AD_PREVIEW")])
         kb.append([ikb("🧹 清空广告","ACT_AD_CLEAR"), ikb("✍️ 设置广告文本","ACT_AD_SET")])
         kb.append([ikb("🗞 立即推送新闻","ACT_NEWS_NOW"),
-                   ikb(("🔴 关闭新闻播报" if news_enabled(chat_id) else "🟢 开启新闻播报"), "ACT_NEWS_TOGGLE")])
+                   ikb(("🔴 关闭新闻播报" if news_on else "🟢 开启新闻播报"), "ACT_NEWS_TOGGLE")])
     # 招商按钮：所有用户可见（本次需求）
     biz_btns=get_biz_buttons()
     if biz_btns:
@@ -676,23 +1117,54 @@ def build_menu(is_admin_user:bool, chat_id:Optional[int]=None)->dict:
     return {"inline_keyboard":kb}
 
 def send_menu_for(chat_id:int, uid:int):
-    send_ephemeral_html(chat_id, "请选择功能：", PANEL_EPHEMERAL_SECONDS, reply_markup=build_menu(is_chat_admin(chat_id, uid), chat_id))
+    send_ephemeral_html(chat_id, "请选择功能：", PANEL_EPHEMERAL_SECONDS, reply_markup=build_menu_json(is_chat_admin(chat_id, uid), chat_id))
 
 # ====================== 报表（查询/拼文案） ======================
+# 同一调度分钟内日报/日终播报/按钮会重复算同一天的聚合，这里按 key 缓存 60 秒；跨天由 scheduler_step 清空
+_AGG_CACHE:Dict[tuple,Tuple[float,object]]={}; _AGG_TTL=60; _AGG_DAY=""
+def _agg_cached(key:tuple, fn:Callable):
+    now=time.monotonic(); hit=_AGG_CACHE.get(key)
+    if hit and now-hit[0]<_AGG_TTL: return hit[1]
+    val=fn(); _AGG_CACHE[key]=(now,val); return val
+def _agg_gc(day:str):
+    global _AGG_DAY
+    if day!=_AGG_DAY: _AGG_CACHE.clear(); _AGG_DAY=day; return
+    now=time.monotonic()
+    for k,(ts,_v) in list(_AGG_CACHE.items()):  # 快照：轮询线程可能同时写入
+        if now-ts>=_AGG_TTL: _AGG_CACHE.pop(k,None)
+def _day_agg(chat_id:int, day:str)->Tuple[int,int]:
+    """(总条数, 发言人数)"""
+    def q():
+        row=_fetchone("SELECT COALESCE(SUM(cnt),0), COUNT(DISTINCT user_id) FROM msg_counts WHERE chat_id=%s AND day=%s",(chat_id,day))
+        return int(row[0] or 0), int(row[1] or 0)
+    return _agg_cached(("day",chat_id,day), q)
+def _month_bounds(ym:str)->Tuple[str,str]:
+    """'2024-12' -> ('2024-12-01', '2025-01-01')：day 是 CHAR(10)，半开区间按字典序正好覆盖整月"""
+    y,m=int(ym[:4]),int(ym[5:7])
+    y2,m2=(y+1,1) if m==12 else (y,m+1)
+    return f"{y:04d}-{m:02d}-01", f"{y2:04d}-{m2:02d}-01"
+def _month_agg(chat_id:int, ym:str)->Tuple[int,int]:
+    """(总条数, 发言人数)，一次扫描取两个聚合"""
+    def q():
+        row=_fetchone("SELECT COALESCE(SUM(cnt),0), COUNT(DISTINCT user_id) FROM msg_counts WHERE chat_id=%s AND day>=%s AND day<%s",(chat_id,*_month_bounds(ym)))
+        return int(row[0] or 0), int(row[1] or 0)
+    return _agg_cached(("month",chat_id,ym), q)
 def list_top_day(chat_id:int, day:str, limit:int=10):
+    return _agg_cached(("top_day",chat_id,day,limit), lambda: _list_top_day(chat_id, day, limit))
+def _list_top_day(chat_id:int, day:str, limit:int):
+    # 主键 (chat_id,user_id,day) 保证单日每人一行，无需 GROUP BY；按 idx_day_cnt 倒序扫前 N 行即可
     return _fetchall("""
         SELECT
             mc.user_id,
-            COALESCE(NULLIF(s.username, ''), MAX(mc.username))       AS username,
-            COALESCE(NULLIF(s.first_name, ''), MAX(mc.first_name))   AS first_name,
-            COALESCE(NULLIF(s.last_name, ''),  MAX(mc.last_name))    AS last_name,
-            SUM(mc.cnt)                                              AS c
+            COALESCE(NULLIF(s.username, ''), mc.username)       AS username,
+            COALESCE(NULLIF(s.first_name, ''), mc.first_name)   AS first_name,
+            COALESCE(NULLIF(s.last_name, ''),  mc.last_name)    AS last_name,
+            mc.cnt                                              AS c
         FROM msg_counts mc
         LEFT JOIN scores s
           ON s.chat_id = mc.chat_id AND s.user_id = mc.user_id
         WHERE mc.chat_id = %s AND mc.day = %s
-        GROUP BY mc.user_id
-        ORDER BY c DESC
+        ORDER BY mc.cnt DESC
         LIMIT %s
     """,(chat_id, day, limit))
 def list_top_month(chat_id:int, ym:str, limit:int=10):
@@ -706,26 +1178,112 @@ def list_top_month(chat_id:int, ym:str, limit:int=10):
         FROM msg_counts mc
         LEFT JOIN scores s
           ON s.chat_id = mc.chat_id AND s.user_id = mc.user_id
-        WHERE mc.chat_id = %s AND mc.day LIKE CONCAT(%s, '-%%')
+        WHERE mc.chat_id = %s AND mc.day >= %s AND mc.day < %s
         GROUP BY mc.user_id
         ORDER BY c DESC
         LIMIT %s
-    """,(chat_id, ym, limit))
+    """,(chat_id, *_month_bounds(ym), limit))
+# 月报：榜单 + 总条数 + 发言人数一次扫描取回（窗口函数在 GROUP BY 之后、LIMIT 之前求值，覆盖全部发言人）
+# MySQL 5.7 没有窗口函数：第一次报 1064 语法错后记下来，之后直接走“榜单 + _month_agg”两条查询
+_WINDOW_FN_OK=True
+def month_report_rows(chat_id:int, ym:str, limit:int=10):
+    """返回 (rows, total, speakers)"""
+    global _WINDOW_FN_OK
+    if _WINDOW_FN_OK:
+        try:
+            got=_fetchall("""
+                SELECT
+                    mc.user_id,
+                    COALESCE(NULLIF(s.username, ''), MAX(mc.username))       AS username,
+                    COALESCE(NULLIF(s.first_name, ''), MAX(mc.first_name))   AS first_name,
+                    COALESCE(NULLIF(s.last_name, ''),  MAX(mc.last_name))    AS last_name,
+                    SUM(mc.cnt)                                              AS c,
+                    SUM(SUM(mc.cnt)) OVER ()                                 AS total,
+                    COUNT(*) OVER ()                                         AS speakers
+                FROM msg_counts mc
+                LEFT JOIN scores s
+                  ON s.chat_id = mc.chat_id AND s.user_id = mc.user_id
+                WHERE mc.chat_id = %s AND mc.day >= %s AND mc.day < %s
+                GROUP BY mc.user_id
+                ORDER BY c DESC
+                LIMIT %s
+            """,(chat_id, *_month_bounds(ym), limit))
+            if not got: return [],0,0
+            return [r[:5] for r in got], int(got[0][5] or 0), int(got[0][6] or 0)
+        except _MySQLProgrammingError as e:
+            if not (e.args and e.args[0]==1064): raise  # 只有语法错（ER_PARSE_ERROR）才说明不支持窗口函数；缺表等照常抛出
+            _WINDOW_FN_OK=False; log(logging.INFO,"window functions unavailable, monthly report falls back to two queries")
+    total,speakers=_month_agg(chat_id, ym)
+    return list_top_month(chat_id, ym, limit), total, speakers
 def list_score_top(chat_id:int, limit:int=10):
     return _fetchall("SELECT user_id, username, first_name, last_name, points FROM scores WHERE chat_id=%s ORDER BY points DESC LIMIT %s",(chat_id,limit))
+# 报表分母：库里直接 COUNT，排除管理员；按群缓存 300 秒（日报/月报常在同一分钟连着算）
+_ELIG_CACHE:Dict[int,Tuple[float,int]]={}; _ELIG_TTL=300
 def eligible_member_count(chat_id:int)->int:
-    admin_ids=list_chat_admin_ids(chat_id)
-    ids=_fetchall("SELECT user_id FROM scores WHERE chat_id=%s AND COALESCE(is_bot,0)=0",(chat_id,))
-    return len([i[0] for i in ids if i[0] not in admin_ids])
-
+    hit=_ELIG_CACHE.get(chat_id)
+    if hit and time.monotonic()-hit[0]<_ELIG_TTL: return hit[1]
+    admin_ids=tuple(list_chat_admin_ids(chat_id))
+    sql="SELECT COUNT(*) FROM scores WHERE chat_id=%s AND COALESCE(is_bot,0)=0"
+    if admin_ids: sql+=" AND user_id NOT IN ("+",".join(["%s"]*len(admin_ids))+")"
+    row=_fetchone(sql,(chat_id,*admin_ids)); n=int(row[0]) if row else 0
+    _ELIG_CACHE[chat_id]=(time.monotonic(),n); return n
+
+_TAG_RE=re.compile(r"<[^>]+>")
+_WS_RE=re.compile(r"\s+")
+class _Strip(HTMLParser):
+    """只收集文本节点（跳过 script/style）；实体由 convert_charrefs 负责还原"""
+    def __init__(self):
+        super().__init__(convert_charrefs=True); self.buf:List[str]=[]; self.skip=0
+    def handle_starttag(self, tag, attrs):
+        if tag in ("script","style"): self.skip+=1
+    def handle_endtag(self, tag):
+        if tag in ("script","style") and self.skip: self.skip-=1
+    def handle_data(self, d:str):
+        if not self.skip: self.buf.append(d)
 def clean_text(s:str)->str:
     if not s: return ""
-    soup=BeautifulSoup(s,"html.parser"); return re.sub(r"\s+"," ", soup.get_text().strip())
+    text=_TAG_RE.sub("", s)
+    if "<" in text:  # 残缺/嵌套标签才走解析器
+        p=_Strip(); p.feed(s); p.close(); text="".join(p.buf)
+    else: text=html.unescape(text)
+    return _WS_RE.sub(" ", text).strip()
+# 调度线程和“立即推送”按钮（更新 worker）可能同时翻译：LRU 的 move_to_end/淘汰要在锁里做，否则会 KeyError
+_ZH_CACHE:"OrderedDict[str,str]"=OrderedDict(); _ZH_CACHE_MAX=4096; _ZH_LOCK=threading.Lock()
+def _zh_remember(src:str, dst:str):
+    with _ZH_LOCK:
+        _ZH_CACHE[src]=dst; _ZH_CACHE.move_to_end(src)
+        while len(_ZH_CACHE)>_ZH_CACHE_MAX: _ZH_CACHE.popitem(last=False)
 def _zh(s:str)->str:
     if not s: return ""
     if not TRANSLATE_TO_ZH or _gt is None: return s
-    try: return _gt.translate(s)
-    except Exception: return s
+    with _ZH_LOCK:
+        hit=_ZH_CACHE.get(s)
+        if hit is not None: _ZH_CACHE.move_to_end(s); return hit
+    try: out=_gt.translate(s) or s
+    except Exception: return s  # 失败不缓存，下轮再试
+    _zh_remember(s, out); return out
+_ZH_SEP="§§§"; _ZH_BATCH_CHARS=4500  # Google 单次上限 5000 字符，留余量
+def _zh_chunks(todo:List[str])->List[List[str]]:
+    """按拼接后的长度切成若干批，每批一次请求"""
+    out:List[List[str]]=[]; cur:List[str]=[]; n=0
+    for x in todo:
+        add=len(x)+len(_ZH_SEP)+2
+        if cur and n+add>_ZH_BATCH_CHARS: out.append(cur); cur=[]; n=0
+        cur.append(x); n+=add
+    if cur: out.append(cur)
+    return out
+def _zh_many(strs:List[str])->List[str]:
+    """批量翻译：未命中缓存的按长度分批拼成一段请求；某批切分条数对不上时该批逐条回退"""
+    if not TRANSLATE_TO_ZH or _gt is None: return list(strs)
+    todo=[x for x in dict.fromkeys(strs) if x and x not in _ZH_CACHE]
+    for batch in _zh_chunks(todo):
+        if len(batch)<2: continue
+        try:
+            out=[x.strip() for x in (_gt.translate(f"\n{_ZH_SEP}\n".join(batch)) or "").split(_ZH_SEP)]
+            if len(out)==len(batch):
+                for src,dst in zip(batch,out): _zh_remember(src, dst or src)
+        except Exception: pass
+    return [_zh(x) for x in strs]
 
 # ====================== 新闻抓取/推送 ======================
 CATEGORY_MAP={
@@ -733,14 +1291,99 @@ CATEGORY_MAP={
     "sea":("东南亚",["https://www.straitstimes.com/news/world/asia/rss.xml"]),
     "war":("国际",["https://feeds.bbci.co.uk/news/world/rss.xml"]),
 }
+def _fast_rss_parse(xml_bytes:bytes, max_items:int)->Optional[List[Dict]]:
+    """RSS 2.0 流式解析，取够 max_items*2 条即停；Atom/RDF 或解析失败返回 None（交给 feedparser）"""
+    out=[]
+    try:
+        for _ev,el in ET.iterparse(io.BytesIO(xml_bytes), events=("end",)):
+            if el.tag!="item": continue
+            out.append({"title":el.findtext("title") or "","link":(el.findtext("link") or "").strip(),"summary":el.findtext("description") or ""})
+            el.clear()
+            if len(out)>=max_items*2: break
+    except ET.ParseError:
+        if not out: return None
+    return out or None
+def _parse_feed_bytes(xml_bytes:bytes, max_items:int)->List[Dict]:
+    """解析 + 清洗（可在子进程里跑，须保持顶层函数以便 pickle）"""
+    entries=_fast_rss_parse(xml_bytes, max_items)
+    if entries is None:
+        entries=[{"title":e.get("title"),"link":e.get("link"),"summary":e.get("summary") or e.get("description")}
+                 for e in feedparser.parse(xml_bytes).entries[:max_items*2]]
+    items=[]
+    for e in entries:
+        title=clean_text(e["title"]); link=e["link"] or ""; summary=clean_text(e["summary"])
+        if title and link: items.append({"title":title,"link":link,"summary":summary})
+    return items
+# 三个分类会同时走到这里：建池要加锁，否则首轮推送会建出好几个池。
+# 主进程此时已有日志/发送/调度/更新等线程，fork 出子进程可能继承别的线程持有的锁而死锁：用 forkserver（没有就 spawn）
+_PARSE_POOL:Optional[ProcessPoolExecutor]=None; _PARSE_POOL_LOCK=threading.Lock()
+def _parse_pool()->Optional[ProcessPoolExecutor]:
+    global _PARSE_POOL
+    if _PARSE_POOL is None and RSS_PARSE_WORKERS>1:
+        with _PARSE_POOL_LOCK:
+            if _PARSE_POOL is None:
+                ctx=multiprocessing.get_context("forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn")
+                _PARSE_POOL=ProcessPoolExecutor(max_workers=RSS_PARSE_WORKERS, mp_context=ctx)
+                atexit.register(_PARSE_POOL.shutdown, wait=False, cancel_futures=True)
+    return _PARSE_POOL
+# 条件 GET：记住每个源上次的 ETag/Last-Modified 和解析结果，源没更新（304）时直接复用，不下载也不解析。
+# 只放内存——重启后没有旧结果可复用，也就不该发条件头
+_FEED_CACHE:Dict[str,Tuple[str,str,List[Dict]]]={}  # url -> (etag, last_modified, items)
+# RSS 源单独一个会话：各站点连接 keep-alive 复用；GET 幂等，5xx 退避重试两次。超时拆成 (建连 5 秒, 读 RSS_FETCH_TIMEOUT)
+_FEED_SESSION=requests.Session()
+_FEED_SESSION.mount("http://", requests.adapters.HTTPAdapter(pool_connections=16, pool_maxsize=32,
+                    max_retries=Retry(total=2, backoff_factor=0.5, status_forcelist=(500,502,503,504))))
+_FEED_SESSION.mount("https://", _FEED_SESSION.get_adapter("http://"))
+def _fetch_feed_bytes(u:str, hdr:Dict[str,str]):
+    """返回 requests 响应；返回 HTML 页面（多半是报错/验证页）时记一条警告并返回 None"""
+    r=_FEED_SESSION.get(u, timeout=(5, RSS_FETCH_TIMEOUT), headers=hdr)
+    if r.status_code!=304:
+        r.raise_for_status()
+        if "text/html" in (r.headers.get("Content-Type") or ""):
+            log(logging.WARNING,"rss not xml",event="rss",error=f"{u} {r.headers.get('Content-Type')}"); return None
+    return r
+# 连续失败的源按指数退避：5 分钟起翻倍、最多 6 小时，冷却期内直接跳过，不再每轮占着下载线程等超时；成功一次即清零
+_FEED_FAILS:Dict[str,Tuple[int,float]]={}  # url -> (连续失败次数, 冷却到期 monotonic)
+_FEED_BACKOFF_BASE=300; _FEED_BACKOFF_MAX=6*3600
+def _feed_failed(u:str):
+    n=_FEED_FAILS.get(u,(0,0.0))[0]+1
+    _FEED_FAILS[u]=(n, time.monotonic()+min(_FEED_BACKOFF_MAX, _FEED_BACKOFF_BASE*2**(n-1)))
+def _download_feed(u:str)->Tuple[Optional[bytes],Tuple[str,str],Optional[List[Dict]]]:
+    """返回 (body, (etag, last_modified), 304 时复用的 items)"""
+    fail=_FEED_FAILS.get(u)
+    if fail and time.monotonic()<fail[1]: return None, ("",""), None
+    hdr={"User-Agent":"Mozilla/5.0"}; hit=_FEED_CACHE.get(u)
+    if hit:
+        if hit[0]: hdr["If-None-Match"]=hit[0]
+        if hit[1]: hdr["If-Modified-Since"]=hit[1]
+    try:
+        r=_fetch_feed_bytes(u, hdr)
+        if r is None: _feed_failed(u); return None, ("",""), None
+        if fail: _FEED_FAILS.pop(u, None)
+        if r.status_code==304: return (None, (hit[0],hit[1]), hit[2]) if hit else (None, ("",""), None)
+        return r.content, (r.headers.get("ETag") or "", r.headers.get("Last-Modified") or ""), None
+    except Exception as e:
+        _feed_failed(u); log(logging.WARNING,"rss fetch error",event="rss",error=f"{u} {e}"); return None, ("",""), None
 def fetch_rss_list(urls:List[str], max_items:int)->List[Dict]:
+    """线程并发下载；哪个源先下完就先把它的解析（expat 吃 CPU）丢进进程池，避开 GIL；结果仍按 urls 顺序合并"""
     items=[]
-    for u in urls:
+    if not urls: return items
+    pool=_parse_pool(); jobs:List[Optional[tuple]]=[None]*len(urls)
+    with ThreadPoolExecutor(max_workers=min(8,len(urls))) as ex:
+        dl={ex.submit(_download_feed, u):i for i,u in enumerate(urls)}
+        for f in as_completed(dl):  # _download_feed 自己吞异常
+            i=dl[f]; u=urls[i]; body,meta,cached=f.result()
+            if cached is not None: jobs[i]=(u, None, meta, None, cached); continue
+            if body is None: continue
+            try: jobs[i]=(u, body, meta, pool.submit(_parse_feed_bytes, body, max_items) if pool else None, None)
+            except Exception: jobs[i]=(u, body, meta, None, None)  # 池已损坏时退回本进程
+    for u,body,meta,fut,cached in filter(None, jobs):
+        if cached is not None: items.extend(cached); continue
         try:
-            feed=feedparser.parse(u)
-            for e in feed.entries[:max_items*2]:
-                title=clean_text(e.get("title")); link=e.get("link") or ""; summary=clean_text(e.get("summary") or e.get("description"))
-                if title and link: items.append({"title":title,"link":link,"summary":summary})
+            part=fut.result() if fut else _parse_feed_bytes(body, max_items)
+            items.extend(part)
+            if meta[0] or meta[1]: _FEED_CACHE[u]=(meta[0], meta[1], part)
+            else: _FEED_CACHE.pop(u, None)
         except Exception as e:
             log(logging.WARNING,"rss parse error",event="rss",error=f"{u} {e}")
     seen=set(); uniq=[]
@@ -749,42 +1392,76 @@ def fetch_rss_list(urls:List[str], max_items:int)->List[Dict]:
         seen.add(it["link"]); uniq.append(it)
         if len(uniq)>=max_items: break
     return uniq
-def already_posted(chat_id:int, category:str, link:str)->bool:
-    return _fetchone("SELECT 1 FROM posted_news WHERE chat_id=%s AND category=%s AND link=%s",(chat_id,category,link)) is not None
-def mark_posted(chat_id:int, category:str, link:str):
-    _exec("INSERT IGNORE INTO posted_news(chat_id,category,link,ts) VALUES(%s,%s,%s,%s)",(chat_id,category,link,utcnow().isoformat()))
+# 已推送 (chat, category, link) 的进程内记录：RSS 每轮大多是上一轮的老链接，命中后不再查库；只有没见过的链接才走 IN 查询
+_POSTED_CACHE:"OrderedDict[Tuple[int,str,str],None]"=OrderedDict(); _POSTED_CACHE_MAX=20000
+def _posted_remember(chat_id:int, category:str, links):
+    for l in links: _POSTED_CACHE[(chat_id,category,l)]=None
+    while len(_POSTED_CACHE)>_POSTED_CACHE_MAX: _POSTED_CACHE.popitem(last=False)
+def posted_links(chat_id:int, category:str, links:List[str])->set:
+    """取回其中已推送过的链接：先查缓存，未命中的一次 IN 查询"""
+    done={l for l in links if (chat_id,category,l) in _POSTED_CACHE}
+    misses=[l for l in links if l not in done]
+    if misses:
+        rows=_fetchall("SELECT link FROM posted_news WHERE chat_id=%s AND category=%s AND link IN ("+",".join(["%s"]*len(misses))+")",
+                       (chat_id,category,*misses))
+        hit={r[0] for r in rows}; _posted_remember(chat_id, category, hit); done|=hit
+    return done
+def mark_posted_many(chat_id:int, category:str, links:List[str]):
+    if not links: return
+    ts=utcnow().isoformat()
+    with db_conn() as conn, conn.cursor() as c:
+        c.executemany("INSERT IGNORE INTO posted_news(chat_id,category,link,ts) VALUES(%s,%s,%s,%s)",[(chat_id,category,l,ts) for l in links])
+    _posted_remember(chat_id, category, links)
+# 定时推送（调度线程）和“立即推送”按钮（更新 worker）可能同时推同一个群：两边都先查 posted_links 再标记，会重复发。
+# 每群一把锁，已有推送在跑就跳过这次（那一轮会发出同样的新闻），不阻塞更新 worker
+_NEWS_PUSH_LOCKS:Dict[int,threading.Lock]={}
 def push_news_once(chat_id:int):
+    lock=_NEWS_PUSH_LOCKS.setdefault(chat_id, threading.Lock())
+    if not lock.acquire(blocking=False):
+        log(logging.INFO,"news push already running, skipped",chat_id=chat_id); return
+    try: _push_news_once(chat_id)
+    finally: lock.release()
+def _push_news_once(chat_id:int):
     if not news_enabled(chat_id): return
     order=["finance","sea","war"]; now_str=tz_now().strftime("%Y-%m-%d %H:%M")
     sent=False
-    for cat in order:
-        cname,feeds=CATEGORY_MAP.get(cat,(cat,[]))
-        items=fetch_rss_list(feeds, NEWS_ITEMS_PER_CAT)
+    en,content,mode,_times,mt,fid=ad_get(chat_id)  # 一次推送内广告不变：取一次，三个分类共用
+    attach=en and mode=="attach"
+    ad_line="📣 <b>广告</b>\n"+safe_html(content) if attach and content.strip() else ""
+    # 三个分类各自的源也同时下载：总耗时≈最慢的一个分类，而不是三者相加
+    with ThreadPoolExecutor(max_workers=len(order)) as ex:
+        fetched=list(ex.map(lambda c: fetch_rss_list(CATEGORY_MAP.get(c,(c,[]))[1], NEWS_ITEMS_PER_CAT), order))
+    for cat,items in zip(order,fetched):
+        cname=CATEGORY_MAP.get(cat,(cat,[]))[0]
         if not items: continue
-        new_items=[it for it in items if not already_posted(chat_id, cat, it["link"])]
+        done=posted_links(chat_id, cat, [it["link"] for it in items])
+        new_items=[it for it in items if it["link"] not in done]
         if not new_items: continue
         lines=[f"🗞️ <b>{cname}</b> | {now_str}"]
+        zh=_zh_many([x for it in new_items for x in (it['title'], it.get('summary') or "")])
         for i,it in enumerate(new_items,1):
-            t=_zh(it['title']); s=_zh(it.get('summary') or "")
+            t,s=zh[2*i-2],zh[2*i-1]
             if s: lines.append(f"{i}. {safe_html(t)}\n{safe_html(s)}\n{it['link']}")
             else: lines.append(f"{i}. {safe_html(t)}\n{it['link']}")
-        en,content,mode,_times,mt,fid=ad_get(chat_id)
-        if en and mode=="attach" and content.strip(): lines.append("📣 <b>广告</b>\n"+safe_html(content))
-        send_message_html(chat_id,"\n".join(lines))
-        if en and mode=="attach" and mt!="none" and fid: ad_send_now(chat_id, preview_only=True)
-        for it in new_items: mark_posted(chat_id, cat, it["link"])
+        if ad_line: lines.append(ad_line)
+        outbox_put(chat_id, send_message_html, chat_id, "\n".join(lines))
+        if attach and mt!="none" and fid: outbox_put(chat_id, ad_send_now, chat_id, preview_only=True)
+        mark_posted_many(chat_id, cat, [it["link"] for it in new_items])
         sent=True
-    if not sent: send_message_html(chat_id,"🗞️ 暂无可用新闻。")
+    if not sent: outbox_put(chat_id, send_message_html, chat_id, "🗞️ 暂无可用新闻。")
 
 # ====================== 调度 ======================
+# 每个调度步会被多处调用：一条 UNION（各表按主键前缀 chat_id 松散索引扫描）并缓存 60 秒
+_KNOWN_CHATS:Tuple[float,List[int]]=(0.0,[]); _KNOWN_CHATS_TTL=60
 def gather_known_chats()->List[int]:
+    global _KNOWN_CHATS
+    ts,cached=_KNOWN_CHATS
+    if cached and time.monotonic()-ts<_KNOWN_CHATS_TTL: return cached
     chats=set(NEWS_CHAT_IDS or [])
-    for r in _fetchall("SELECT DISTINCT chat_id FROM msg_counts",()): chats.add(int(r[0]))
-    for r in _fetchall("SELECT DISTINCT chat_id FROM scores",()): chats.add(int(r[0]))
-    for r in _fetchall("SELECT chat_id FROM ads",()): chats.add(int(r[0]))
-    return sorted(chats)
-def maybe_push_news():
-    key="next_news_at"; nv=state_get(key); now=tz_now()
+    for r in _fetchall("SELECT chat_id FROM msg_counts UNION SELECT chat_id FROM scores UNION SELECT chat_id FROM ads",()): chats.add(int(r[0]))
+    out=sorted(chats); _KNOWN_CHATS=(time.monotonic(),out); return out
+def maybe_push_news(now:Optional[datetime]=None):
+    key="next_news_at"; nv=state_get(key); now=now or tz_now()
     if nv:
         try: next_at=datetime.fromisoformat(nv)
         except Exception: next_at=now - timedelta(minutes=1)
@@ -795,9 +1472,9 @@ def maybe_push_news():
             try: push_news_once(cid)
             except Exception: logger.exception("news push error", extra={"chat_id":cid})
         state_set(key,(now+timedelta(minutes=INTERVAL_MINUTES)).isoformat())
-def maybe_daily_report():
+def maybe_daily_report(now:Optional[datetime]=None):
     if not STATS_ENABLED: return
-    h,m=parse_hhmm(STATS_DAILY_AT); now=tz_now()
+    h,m=parse_hhmm(STATS_DAILY_AT); now=now or tz_now()
     if now.hour!=h or now.minute!=m: return
     chats=STATS_CHAT_IDS or gather_known_chats()
     yday=(now - timedelta(days=1)).strftime("%Y-%m-%d")
@@ -807,16 +1484,13 @@ def maybe_daily_report():
         try:
             send_message_html(cid, build_daily_report(cid, yday))
             rows=list_top_day(cid, yday, limit=TOP_REWARD_SIZE)
-            if rows:
-                bonus=DAILY_TOP_REWARD_START
-                for (uid,un,fn,ln,c) in rows:
-                    _upsert_user_base(cid, {"id":uid,"username":un,"first_name":fn,"last_name":ln})
-                    _add_points(cid, uid, max(bonus,0), uid, "top_day_reward"); bonus-=1
+            bulk_upsert_scores(cid, [(uid,un,fn,ln,max(DAILY_TOP_REWARD_START-i,0),"top_day_reward")
+                                     for i,(uid,un,fn,ln,c) in enumerate(rows)])
         except Exception: logger.exception("daily report error", extra={"chat_id":cid})
         state_set(rk,"1")
-def maybe_monthly_report():
+def maybe_monthly_report(now:Optional[datetime]=None):
     if not STATS_ENABLED: return
-    h,m=parse_hhmm(STATS_MONTHLY_AT); now=tz_now()
+    h,m=parse_hhmm(STATS_MONTHLY_AT); now=now or tz_now()
     if not (now.day==1 and now.hour==h and now.minute==m): return
     last_month=(now.replace(day=1)-timedelta(days=1)).strftime("%Y-%m")
     chats=STATS_CHAT_IDS or gather_known_chats()
@@ -826,16 +1500,12 @@ def maybe_monthly_report():
         try:
             send_message_html(cid, build_monthly_report(cid, last_month))
             rows=list_top_month(cid, last_month, 10)
-            if rows:
-                for idx,(uid,un,fn,ln,c) in enumerate(rows,1):
-                    reward=MONTHLY_REWARD_RULE[idx-1] if idx-1<len(MONTHLY_REWARD_RULE) else 0
-                    if reward>0:
-                        _upsert_user_base(cid, {"id":uid,"username":un,"first_name":fn,"last_name":ln})
-                        _add_points(cid, uid, reward, uid, "top_month_reward")
+            bulk_upsert_scores(cid, [(uid,un,fn,ln,MONTHLY_REWARD_RULE[i],"top_month_reward")
+                                     for i,(uid,un,fn,ln,c) in enumerate(rows) if i<len(MONTHLY_REWARD_RULE) and MONTHLY_REWARD_RULE[i]>0])
         except Exception: logger.exception("monthly report error", extra={"chat_id":cid})
         state_set(rk,"1")
-def maybe_daily_broadcast():
-    h,m=parse_hhmm(DAILY_BROADCAST_AT); now=tz_now()
+def maybe_daily_broadcast(now:Optional[datetime]=None):
+    h,m=parse_hhmm(DAILY_BROADCAST_AT); now=now or tz_now()
     if now.hour!=h or now.minute!=m: return
     day=now.strftime("%Y-%m-%d")
     chats=STATS_CHAT_IDS or gather_known_chats()
@@ -848,38 +1518,68 @@ def maybe_daily_broadcast():
 def maybe_ephemeral_gc_wrap():
     maybe_ephemeral_gc()
 def scheduler_step():
-    maybe_push_news(); maybe_daily_report(); maybe_monthly_report(); maybe_daily_broadcast(); maybe_ephemeral_gc_wrap()
+    now=tz_now()  # 每轮只取一次本地时间，下传给各个定时任务
+    _agg_gc(now.strftime("%Y-%m-%d"))
+    msg_partitions_ensure(now.strftime("%Y-%m"))
+    try: flush_msg_counts()  # 报表/播报前先把缓冲里的计数落库，统计不漏最后几秒
+    except Exception: logger.exception("msg count flush error")
+    maybe_push_news(now); maybe_daily_report(now); maybe_monthly_report(now); maybe_daily_broadcast(now); maybe_ephemeral_gc_wrap()
 
 # ====================== 报表文本函数 ======================
+# 成品报表文本也缓存：当天/当月走 60 秒的聚合缓存；已结束的日/月不会再变，放进 FIFO 长留。
+# “已结束”要过了收尾期才算：最后一批发言计数可能还在写缓冲里，60 秒的聚合缓存里也可能是收尾前的旧数
+_REPORT_FINAL:"OrderedDict[tuple,str]"=OrderedDict(); _REPORT_FINAL_MAX=256; _REPORT_FINAL_GRACE=600
+def _msg_buf_has(prefix:str)->bool:
+    with _MSG_BUF_LOCK: return any(k[2].startswith(prefix) for k in _MSG_BUF)
+def _report_cached(key:tuple, period:str, final:bool, fn:Callable[[],str])->str:
+    if not final: return _agg_cached(key, fn)
+    hit=_REPORT_FINAL.get(key)
+    if hit is not None: return hit
+    flush_msg_counts()
+    val=fn()
+    if _msg_buf_has(period): return val  # 该时段还有没落库的计数（写失败等下轮重试）：这次不当成品缓存
+    _REPORT_FINAL[key]=val
+    if len(_REPORT_FINAL)>_REPORT_FINAL_MAX: _REPORT_FINAL.popitem(last=False)
+    return val
+def _closed_before()->datetime: return tz_now()-timedelta(seconds=_REPORT_FINAL_GRACE)
 def build_daily_report(chat_id:int, day:str)->str:
-    rows=list_top_day(chat_id, day, limit=10)
-    total=_fetchone("SELECT SUM(cnt) FROM msg_counts WHERE chat_id=%s AND day=%s",(chat_id,day))[0] or 0
-    speakers=_fetchone("SELECT COUNT(DISTINCT user_id) FROM msg_counts WHERE chat_id=%s AND day=%s",(chat_id,day))[0] or 0
+    return _report_cached(("rep_day",chat_id,day), day, day<_closed_before().strftime("%Y-%m-%d"), lambda: _build_daily_report(chat_id, day))
+def build_monthly_report(chat_id:int, ym:str)->str:
+    return _report_cached(("rep_month",chat_id,ym), ym, ym<_closed_before().strftime("%Y-%m"), lambda: _build_monthly_report(chat_id, ym))
+def _build_daily_report(chat_id:int, day:str)->str:
+    rows=list_top_day(chat_id, day, limit=10); warm_user_names(chat_id, rows)
+    total,speakers=_day_agg(chat_id, day)
     members=eligible_member_count(chat_id)
     lines=[f"📊 <b>{day} 发言统计</b>", f"参与成员（剔除管理员/机器人）：<b>{members}</b>｜发言人数：<b>{speakers}</b>｜总条数：<b>{total}</b>"]
     if not rows: lines.append("暂无数据。"); return "\n".join(lines)
     for i,(uid,un,fn,ln,c) in enumerate(rows,1):
         lines.append(f"{i}. {rank_display_link(chat_id, uid, un, fn, ln)} — <b>{c}</b>")
     return "\n".join(lines)
-def build_monthly_report(chat_id:int, ym:str)->str:
-    rows=list_top_month(chat_id, ym, limit=10)
-    total=_fetchone("SELECT SUM(cnt) FROM msg_counts WHERE chat_id=%s AND day LIKE CONCAT(%s,'-%')",(chat_id,ym))[0] or 0
-    speakers=_fetchone("SELECT COUNT(DISTINCT user_id) FROM msg_counts WHERE chat_id=%s AND day LIKE CONCAT(%s,'-%')",(chat_id,ym))[0] or 0
+def _build_monthly_report(chat_id:int, ym:str)->str:
+    rows,total,speakers=month_report_rows(chat_id, ym, 10); warm_user_names(chat_id, rows)
     members=eligible_member_count(chat_id)
     lines=[f"📈 <b>{ym} 月度发言统计</b>", f"参与成员（剔除管理员/机器人）：<b>{members}</b>｜发言人数：<b>{speakers}</b>｜总条数：<b>{total}</b>"]
     if not rows: lines.append("暂无数据。"); return "\n".join(lines)
     for i,(uid,un,fn,ln,c) in enumerate(rows,1):
         lines.append(f"{i}. {rank_display_link(chat_id, uid, un, fn, ln)} — <b>{c}</b>")
     return "\n".join(lines)
+# 积分榜正文（不含标题，无数据返回空串）：/top10、按钮、日终播报共用，按 (chat, limit) 缓存 10 秒，积分变动时作废
+_LB_CACHE:Dict[Tuple[int,int],Tuple[float,str]]={}; _LB_TTL=10
+def _lb_forget(chat_id:int):
+    for k in [k for k in list(_LB_CACHE) if k[0]==chat_id]: _LB_CACHE.pop(k,None)
+def render_leaderboard(chat_id:int, limit:int=10)->str:
+    hit=_LB_CACHE.get((chat_id,limit)); now=time.monotonic()
+    if hit and now-hit[0]<_LB_TTL: return hit[1]
+    rows=list_score_top(chat_id, limit); warm_user_names(chat_id, rows); link=rank_display_link
+    body="\n".join(f"{i}. {link(chat_id, u, un, fn, ln)} — <b>{pts}</b> 分" for i,(u,un,fn,ln,pts) in enumerate(rows, 1))
+    _LB_CACHE[(chat_id,limit)]=(now,body); return body
 def build_day_broadcast(chat_id:int, day:str)->str:
-    speakers=_fetchone("SELECT COUNT(DISTINCT user_id) FROM msg_counts WHERE chat_id=%s AND day=%s",(chat_id,day))[0] or 0
+    _total,speakers=_day_agg(chat_id, day)
     lines=[f"🕛 <b>{day} 日终播报</b>", f"🧑‍🤝‍🧑 活跃人数：<b>{speakers}</b>"]
-    rows_s=list_score_top(chat_id,10); lines.append("🏆 <b>积分榜 Top10</b>")
-    if not rows_s: lines.append("（暂无积分数据）")
-    else:
-        for i,(uid,un,fn,ln,pts) in enumerate(rows_s,1):
-            lines.append(f"{i}. {rank_display_link(chat_id, uid, un, fn, ln)} — <b>{pts}</b> 分")
-    rows_m=list_top_day(chat_id, day,10); lines.append("💬 <b>发言 Top10</b>")
+    rows_m=list_top_day(chat_id, day,10); warm_user_names(chat_id, rows_m)
+    lines.append("🏆 <b>积分榜 Top10</b>")
+    lines.append(render_leaderboard(chat_id, 10) or "（暂无积分数据）")
+    lines.append("💬 <b>发言 Top10</b>")
     if not rows_m: lines.append("（今日暂无发言数据）")
     else:
         for i,(uid,un,fn,ln,c) in enumerate(rows_m,1):
@@ -890,7 +1590,7 @@ def build_day_broadcast(chat_id:int, day:str)->str:
 def find_user_by_username(chat_id:int, username:str)->Optional[Tuple[int,str,str,str]]:
     uname=(username or "").lstrip("@").strip()
     if not uname: return None
-    row=_fetchone("SELECT user_id, username, first_name, last_name FROM scores WHERE chat_id=%s AND LOWER(username)=LOWER(%s) LIMIT 1",(chat_id, uname))
+    row=_fetchone("SELECT user_id, username, first_name, last_name FROM scores WHERE chat_id=%s AND username=%s LIMIT 1",(chat_id, uname))  # _ci 排序规则本身不分大小写，等值比较才能走 idx_username
     if row: return (int(row[0]), row[1] or "", row[2] or "", row[3] or "")
     row=_fetchone("""SELECT mc.user_id, mc.username, mc.first_name, mc.last_name 
                      FROM msg_counts mc 
@@ -900,9 +1600,7 @@ def find_user_by_username(chat_id:int, username:str)->Optional[Tuple[int,str,str
     return None
 
 def admin_adjust_points_by_uid(chat_id:int, admin_id:int, target_uid:int, delta:int, reason:str)->int:
-    before=_get_points(chat_id, target_uid)
-    _add_points(chat_id, target_uid, delta, admin_id, reason)
-    after=_get_points(chat_id, target_uid)
+    after=_add_points(chat_id, target_uid, delta, admin_id, reason)
     sign="+" if delta>=0 else ""
     send_message_html(chat_id, f"🛠 管理员已调整积分：\n目标：<a href=\"tg://user?id={target_uid}\">ID:{target_uid}</a>\n变动：<b>{sign}{delta}</b>\n当前：<b>{after}</b>", disable_preview=True)
     return after
@@ -913,15 +1611,17 @@ def admin_adjust_points(chat_id:int, admin_id:int, username:str, delta:int, reas
         send_message_html(chat_id, "未找到该用户名的成员。\n小技巧：可以直接<b>回复目标成员的消息</b>并发送“/score_add 200”或“/score_sub 50”。")
         return
     uid,un,fn,ln=found
-    before=_get_points(chat_id, uid)
-    _add_points(chat_id, uid, delta, admin_id, reason)
-    after=_get_points(chat_id, uid)
+    after=_add_points(chat_id, uid, delta, admin_id, reason)
     name_link=rank_display_link(chat_id, uid, un, fn, ln)
     sign="+" if delta>=0 else ""
     send_message_html(chat_id, f"🛠 管理员已调整积分：\n目标：{name_link}\n变动：<b>{sign}{delta}</b>\n当前：<b>{after}</b>", disable_preview=True)
 
+# 积分/兑换相关的输入解析：模式预编译一次
+_USER_AMT_RE=re.compile(r"(?:^|\s)@?([A-Za-z0-9_]{5,32})\s+([+-]?\d+)(?:\s|$)")
+_INT_RE=re.compile(r"([+-]?\d+)")
+_REDEEM_AMT_RE=re.compile(r"^\s*(\d+)\s*([uU]|分|积分|点|points?|pts?)?\s*$")
 def parse_username_and_amount(text:str)->Tuple[Optional[str], Optional[int]]:
-    m=re.search(r"(?:^|\s)@?([A-Za-z0-9_]{5,32})\s+([+-]?\d+)(?:\s|$)", text.strip())
+    m=_USER_AMT_RE.search(text.strip())
     if not m: return None, None
     return m.group(1), int(m.group(2))
 
@@ -953,7 +1653,7 @@ def parse_redeem_amount_input(text:str, current_points:int)->Tuple[Optional[int]
     if text.lower() in ("all","max","最大","全部"):
         max_u = current_points // REDEEM_RATE
         return (max_u if max_u>=1 else None), (None if max_u>=1 else "当前积分不足以兑换 1U")
-    m = re.match(r"^\s*(\d+)\s*([uU]|分|积分|点|points?|pts?)?\s*$", text)
+    m = _REDEEM_AMT_RE.match(text)
     if not m:
         return None, "格式不正确。示例：50U 或 10000分"
     n = int(m.group(1)); unit = (m.group(2) or "").lower()
@@ -989,96 +1689,134 @@ def do_checkin(chat_id:int, uid:int, frm:dict):
     today=tz_now().strftime("%Y-%m-%d")
     if _get_last_checkin(chat_id, uid)==today:
         send_message_html(chat_id, f"✅ 你今天已经签到过啦（{today}）。"); return
-    _add_points(chat_id, uid, SCORE_CHECKIN_POINTS, uid, "daily_checkin")
+    total=_add_points(chat_id, uid, SCORE_CHECKIN_POINTS, uid, "daily_checkin")
     _set_last_checkin(chat_id, uid, today)
     un,fn,ln=ensure_user_display(chat_id, uid, (frm.get("username") or "", frm.get("first_name") or "", frm.get("last_name") or ""))
     full=(f"{fn or ''} {ln or ''}").strip() or (f"@{un}" if un else f"ID:{uid}")
-    total=_get_points(chat_id, uid)
     send_message_html(chat_id, f"签到人：<b>{safe_html(full)}</b>\n签到成功：<b>积分+{SCORE_CHECKIN_POINTS}</b>\n总积分为：<b>{total}</b>")
 
+# offset 每批写本地文件（原子替换），库里的 tg_update_offset 只每 60 秒及退出时同步一次；启动取两者较大值
+_OFFSET:Optional[int]=None; _OFFSET_SYNCED:Optional[int]=None; _OFFSET_SYNC_TS=0.0
 def _next_update_offset()->int:
-    v=state_get("tg_update_offset")
-    try: return int(v)
-    except Exception: return 0
-def _set_update_offset(v:int): state_set("tg_update_offset", str(v))
-
-def _handle_command(chat_id: int, uid: int, frm: dict, text: str, msg: Optional[dict] = None):
-    parts=text.strip().split(); cmd=parts[0].lower()
-
-    if cmd in ("/cancel","/stop","/exit","/esc") or parts[0] in ("取消","结束"):
-        clear_pending_states(chat_id, uid); send_ephemeral_html(chat_id,"已取消当前操作。", POPUP_EPHEMERAL_SECONDS); return
-
-    if cmd in ("/start","/menu") or parts[0] in ("菜单","导航"):
-        clear_pending_states(chat_id, uid); send_menu_for(chat_id, uid); return
+    global _OFFSET, _OFFSET_SYNCED
+    if _OFFSET is None:
+        vals=[0]
+        try:
+            with open(OFFSET_FILE) as f: vals.append(int(f.read().strip() or 0))
+        except (OSError, ValueError): pass
+        try: _OFFSET_SYNCED=int(state_get("tg_update_offset") or 0); vals.append(_OFFSET_SYNCED)
+        except Exception: pass
+        _OFFSET=max(vals)
+    return _OFFSET
+def _set_update_offset(v:int):
+    global _OFFSET
+    _OFFSET=v
+    try:
+        tmp=OFFSET_FILE+".tmp"
+        with open(tmp,"w") as f: f.write(str(v))
+        os.replace(tmp, OFFSET_FILE)
+    except OSError as e:
+        log(logging.WARNING,"offset file write failed",event="offset",error=str(e)); _sync_update_offset(); return
+    if time.monotonic()-_OFFSET_SYNC_TS>=OFFSET_DB_SYNC_SECONDS: _sync_update_offset()
+def _sync_update_offset():
+    global _OFFSET_SYNCED, _OFFSET_SYNC_TS
+    if _OFFSET is None or _OFFSET==_OFFSET_SYNCED: return
+    try: state_set("tg_update_offset", str(_OFFSET)); _OFFSET_SYNCED=_OFFSET; _OFFSET_SYNC_TS=time.monotonic()
+    except Exception: logger.exception("offset sync error")
+atexit.register(_sync_update_offset)
+
+def _cmd_cancel(chat_id:int, uid:int, frm:dict, text:str, msg:Optional[dict]):
+    clear_pending_states(chat_id, uid); send_ephemeral_html(chat_id,"已取消当前操作。", POPUP_EPHEMERAL_SECONDS)
+def _cmd_menu(chat_id:int, uid:int, frm:dict, text:str, msg:Optional[dict]):
+    clear_pending_states(chat_id, uid); send_menu_for(chat_id, uid)
+def _cmd_help(chat_id:int, uid:int, frm:dict, text:str, msg:Optional[dict]):
+    send_ephemeral_html(chat_id, HELP_TEXT, POPUP_EPHEMERAL_SECONDS)
+def _cmd_rules(chat_id:int, uid:int, frm:dict, text:str, msg:Optional[dict]):
+    send_ephemeral_html(chat_id, build_rules_text(chat_id), POPUP_EPHEMERAL_SECONDS)
+def _cmd_checkin(chat_id:int, uid:int, frm:dict, text:str, msg:Optional[dict]):
+    do_checkin(chat_id, uid, frm)
+def _cmd_score(chat_id:int, uid:int, frm:dict, text:str, msg:Optional[dict]):
+    pts = _get_points(chat_id, uid)
+    send_ephemeral_html(chat_id, f"你的当前积分：<b>{pts}</b>", POPUP_EPHEMERAL_SECONDS)
+def _cmd_top10(chat_id:int, uid:int, frm:dict, text:str, msg:Optional[dict]):
+    body = render_leaderboard(chat_id, 10)
+    if not body:
+        send_ephemeral_html(chat_id, "暂无积分数据。", POPUP_EPHEMERAL_SECONDS); return
+    send_ephemeral_html(chat_id, "🏆 <b>积分榜 Top10</b>\n" + body, POPUP_EPHEMERAL_SECONDS)
+
+# 兑换 U（先收数量，再收地址；也支持 /redeem 50U 直接跳过收数量）
+def _cmd_redeem(chat_id:int, uid:int, frm:dict, text:str, msg:Optional[dict]):
+    parts = text.split()
+    pts = _get_points(chat_id, uid)
+    if pts < REDEEM_MIN_POINTS:
+        send_ephemeral_html(chat_id, f"当前积分 <b>{pts}</b>，未达兑换门槛（≥{REDEEM_MIN_POINTS}）。", POPUP_EPHEMERAL_SECONDS); return
+    if len(parts) >= 2:
+        u_amount, err = parse_redeem_amount_input("".join(parts[1:]), pts)
+        if err:
+            send_ephemeral_html(chat_id, err, POPUP_EPHEMERAL_SECONDS); return
+        state_set(f"pending:redeemaddr:{chat_id}:{uid}", str(u_amount))
+        send_ephemeral_html(chat_id, f"请回复 <b>TRC20</b> 收款地址（以 <code>T</code> 开头）。\n本次计划兑换：<b>{u_amount} U</b>", POPUP_EPHEMERAL_SECONDS)
+        return
+    state_set(f"pending:redeemamount:{chat_id}:{uid}", "1")
+    max_u = pts // REDEEM_RATE
+    send_ephemeral_html(
+        chat_id,
+        "请输入要兑换的数量：\n"
+        "• 例：<code>50U</code>（按U）或 <code>10000分</code>（按积分）。\n"
+        "• 也可发送 <code>最大</code>/<code>all</code>/<code>max</code> 兑换可兑上限。\n"
+        f"当前积分：<b>{pts}</b>（可兑上限：<b>{max_u}</b>U）",
+        POPUP_EPHEMERAL_SECONDS
+    )
 
-    if cmd in ("/help", "帮助"):
-        send_ephemeral_html(chat_id, HELP_TEXT, POPUP_EPHEMERAL_SECONDS); return
-    if cmd in ("/rules", "规则"):
-        send_ephemeral_html(chat_id, build_rules_text(chat_id), POPUP_EPHEMERAL_SECONDS); return
-    if cmd in ("/checkin", "签到"):
-        do_checkin(chat_id, uid, frm); return
-    if cmd in ("/score", "/points", "我的积分"):
-        pts = _get_points(chat_id, uid)
-        send_ephemeral_html(chat_id, f"你的当前积分：<b>{pts}</b>", POPUP_EPHEMERAL_SECONDS); return
-    if cmd in ("/top10", "积分榜"):
-        rows = list_score_top(chat_id, 10)
-        if not rows:
-            send_ephemeral_html(chat_id, "暂无积分数据。", POPUP_EPHEMERAL_SECONDS); return
-        lines = ["🏆 <b>积分榜 Top10</b>"]
-        for i,(u,un,fn,ln,pts) in enumerate(rows, 1):
-            lines.append(f"{i}. {rank_display_link(chat_id, u, un, fn, ln)} — <b>{pts}</b> 分")
-        send_ephemeral_html(chat_id, "\n".join(lines), POPUP_EPHEMERAL_SECONDS); return
-
-    # 兑换 U（先收数量，再收地址；也支持 /redeem 50U 直接跳过收数量）
-    if cmd == "/redeem" or cmd == "兑换u" or cmd == "积分兑u":
-        pts = _get_points(chat_id, uid)
-        if pts < REDEEM_MIN_POINTS:
-            send_ephemeral_html(chat_id, f"当前积分 <b>{pts}</b>，未达兑换门槛（≥{REDEEM_MIN_POINTS}）。", POPUP_EPHEMERAL_SECONDS); return
-        if len(parts) >= 2:
-            u_amount, err = parse_redeem_amount_input("".join(parts[1:]), pts)
-            if err:
-                send_ephemeral_html(chat_id, err, POPUP_EPHEMERAL_SECONDS); return
-            state_set(f"pending:redeemaddr:{chat_id}:{uid}", str(u_amount))
-            send_ephemeral_html(chat_id, f"请回复 <b>TRC20</b> 收款地址（以 <code>T</code> 开头）。\n本次计划兑换：<b>{u_amount} U</b>", POPUP_EPHEMERAL_SECONDS)
-            return
-        state_set(f"pending:redeemamount:{chat_id}:{uid}", "1")
-        max_u = pts // REDEEM_RATE
-        send_ephemeral_html(
-            chat_id,
-            "请输入要兑换的数量：\n"
-            "• 例：<code>50U</code>（按U）或 <code>10000分</code>（按积分）。\n"
-            "• 也可发送 <code>最大</code>/<code>all</code>/<code>max</code> 兑换可兑上限。\n"
-            f"当前积分：<b>{pts}</b>（可兑上限：<b>{max_u}</b>U）",
-            POPUP_EPHEMERAL_SECONDS
-        ); return
-
-    # 管理员命令：/score_add /score_sub
-    if cmd in ("/score_add", "/score_sub"):
-        if not is_chat_admin(chat_id, uid):
-            send_ephemeral_html(chat_id, "仅管理员可使用积分管理。", POPUP_EPHEMERAL_SECONDS); return
-        mode = "add" if cmd == "/score_add" else "sub"
-        if msg and msg.get("reply_to_message"):
-            m = re.search(r"([+-]?\d+)", text)
-            if not m:
-                send_ephemeral_html(chat_id, "请在命令后写上数值，例如：/score_add 200。", POPUP_EPHEMERAL_SECONDS); return
-            amt = int(m.group(1))
-            if mode == "sub" and amt > 0: amt = -amt
-            target = (msg["reply_to_message"].get("from") or {}).get("id")
-            if not target:
-                send_ephemeral_html(chat_id, "未识别到被回复的目标用户。", POPUP_EPHEMERAL_SECONDS); return
-            admin_adjust_points_by_uid(chat_id, uid, target, amt, f"admin_{mode}")
-            return
-        uname, amt = parse_username_and_amount(text)
-        if not uname or amt is None:
-            send_ephemeral_html(chat_id, "用法：\n/score_add @username 200\n/score_sub @username 50\n或先<b>回复</b>目标消息后发：/score_add 200", POPUP_EPHEMERAL_SECONDS); return
+# 管理员命令：/score_add /score_sub
+def _cmd_score_adjust(chat_id:int, uid:int, frm:dict, text:str, msg:Optional[dict]):
+    if not is_chat_admin(chat_id, uid):
+        send_ephemeral_html(chat_id, "仅管理员可使用积分管理。", POPUP_EPHEMERAL_SECONDS); return
+    mode = "add" if text.split(None,1)[0].lower() == "/score_add" else "sub"
+    if msg and msg.get("reply_to_message"):
+        m = _INT_RE.search(text)
+        if not m:
+            send_ephemeral_html(chat_id, "请在命令后写上数值，例如：/score_add 200。", POPUP_EPHEMERAL_SECONDS); return
+        amt = int(m.group(1))
         if mode == "sub" and amt > 0: amt = -amt
-        admin_adjust_points(chat_id, uid, uname, amt, f"admin_{mode}"); return
+        target = (msg["reply_to_message"].get("from") or {}).get("id")
+        if not target:
+            send_ephemeral_html(chat_id, "未识别到被回复的目标用户。", POPUP_EPHEMERAL_SECONDS); return
+        admin_adjust_points_by_uid(chat_id, uid, target, amt, f"admin_{mode}")
+        return
+    uname, amt = parse_username_and_amount(text)
+    if not uname or amt is None:
+        send_ephemeral_html(chat_id, "用法：\n/score_add @username 200\n/score_sub @username 50\n或先<b>回复</b>目标消息后发：/score_add 200", POPUP_EPHEMERAL_SECONDS); return
+    if mode == "sub" and amt > 0: amt = -amt
+    admin_adjust_points(chat_id, uid, uname, amt, f"admin_{mode}")
 
-    if cmd == "/adset" and is_chat_admin(chat_id, uid):
-        state_set(f"pending:set_ad_text:{chat_id}:{uid}", "1")
-        send_ephemeral_html(chat_id, "请发送广告文本（发送后立即保存）。", POPUP_EPHEMERAL_SECONDS); return
-    if cmd == "/adtimes" and is_chat_admin(chat_id, uid):
-        ad_timepicker_open(chat_id, uid); return
+def _cmd_adset(chat_id:int, uid:int, frm:dict, text:str, msg:Optional[dict]):
+    if not is_chat_admin(chat_id, uid): return
+    pending_mark(chat_id, uid, "set_ad_text")
+    send_ephemeral_html(chat_id, "请发送广告文本（发送后立即保存）。", POPUP_EPHEMERAL_SECONDS)
+def _cmd_adtimes(chat_id:int, uid:int, frm:dict, text:str, msg:Optional[dict]):
+    if is_chat_admin(chat_id, uid): ad_timepicker_open(chat_id, uid)
+
+# 命令 -> 处理函数（首词小写后查表）
+_CMD_HANDLERS:Dict[str,Callable]={
+    **dict.fromkeys(("/cancel","/stop","/exit","/esc","取消","结束"), _cmd_cancel),
+    **dict.fromkeys(("/start","/menu","菜单","导航"), _cmd_menu),
+    **dict.fromkeys(("/help","帮助"), _cmd_help),
+    **dict.fromkeys(("/rules","规则"), _cmd_rules),
+    **dict.fromkeys(("/checkin","签到"), _cmd_checkin),
+    **dict.fromkeys(("/score","/points","我的积分"), _cmd_score),
+    **dict.fromkeys(("/top10","积分榜"), _cmd_top10),
+    **dict.fromkeys(("/redeem","兑换u","积分兑u"), _cmd_redeem),
+    **dict.fromkeys(("/score_add","/score_sub"), _cmd_score_adjust),
+    "/adset": _cmd_adset,
+    "/adtimes": _cmd_adtimes,
+}
+
+def _handle_command(chat_id: int, uid: int, frm: dict, text: str, msg: Optional[dict] = None):
+    head=text.split(None,1)  # 只需首词查表，参数留给各处理函数自己解析
+    if not head: return
+    h=_CMD_HANDLERS.get(head[0].lower())
+    if h: h(chat_id, uid, frm, text, msg)
 
 def _handle_pending_inputs(msg: dict) -> bool:
     chat_id = (msg.get("chat") or {}).get("id")
@@ -1093,9 +1831,12 @@ def _handle_pending_inputs(msg: dict) -> bool:
             return True
         return False
 
+    pend = pending_of(chat_id, uid)
+    if not pend: return False
+
     # 0) 兑U数量
     pend_amount_key = f"pending:redeemamount:{chat_id}:{uid}"
-    if state_get(pend_amount_key):
+    if pend.get(pend_amount_key):
         pts = _get_points(chat_id, uid)
         u_amount, err = parse_redeem_amount_input(text, pts)
         if err:
@@ -1108,7 +1849,7 @@ def _handle_pending_inputs(msg: dict) -> bool:
 
     # 1) 兑U地址
     pend_key = f"pending:redeemaddr:{chat_id}:{uid}"
-    plan = state_get(pend_key)
+    plan = pend.get(pend_key)
     if plan:
         if TRX_ADDR_RE.match(text):
             amt = int(plan)
@@ -1122,7 +1863,7 @@ def _handle_pending_inputs(msg: dict) -> bool:
 
     # 2) 设置广告文本
     pend_key = f"pending:set_ad_text:{chat_id}:{uid}"
-    if state_get(pend_key):
+    if pend.get(pend_key):
         if is_chat_admin(chat_id, uid):
             ad_set(chat_id, text)
             state_del(pend_key)
@@ -1131,7 +1872,7 @@ def _handle_pending_inputs(msg: dict) -> bool:
 
     # 3) 设置广告时间（兼容手输）
     pend_key = f"pending:set_ad_times:{chat_id}:{uid}"
-    if state_get(pend_key):
+    if pend.get(pend_key):
         if is_chat_admin(chat_id, uid):
             t = ad_set_times(chat_id, text)
             state_del(pend_key)
@@ -1140,7 +1881,7 @@ def _handle_pending_inputs(msg: dict) -> bool:
 
     # 4) 设置广告图文（等待媒体）
     pend_key = f"pending:set_ad_media:{chat_id}:{uid}"
-    if state_get(pend_key):
+    if pend.get(pend_key):
         if is_chat_admin(chat_id, uid):
             cap = (msg.get("caption") or text or "").strip()
             if msg.get("photo"):
@@ -1160,10 +1901,10 @@ def _handle_pending_inputs(msg: dict) -> bool:
 
     # 5) 积分管理“模式等待”
     pend_key = f"pending:score:mode:{chat_id}:{uid}"
-    mode = state_get(pend_key)
+    mode = pend.get(pend_key)
     if mode:
         if msg.get("reply_to_message"):
-            m = re.search(r"([+-]?\d+)", text)
+            m = _INT_RE.search(text)
             if m:
                 amt = int(m.group(1))
                 if mode == "sub" and amt > 0: amt = -amt
@@ -1183,174 +1924,244 @@ def _handle_pending_inputs(msg: dict) -> bool:
 
     return False
 
+# ---------- 按钮回调：data -> 处理函数(chat_id, uid, frm, cb) ----------
+def _cb_score(chat_id:int, uid:int, frm:dict, cb:dict):
+    pts = _get_points(chat_id, uid)
+    popup_html(chat_id, f"你的当前积分：<b>{pts}</b>")
+def _cb_sd_today(chat_id:int, uid:int, frm:dict, cb:dict):
+    d = tz_now().strftime("%Y-%m-%d")
+    popup_html(chat_id, build_daily_report(chat_id, d), disable_preview=False)
+def _cb_sm_this(chat_id:int, uid:int, frm:dict, cb:dict):
+    ym = tz_now().strftime("%Y-%m")
+    popup_html(chat_id, build_monthly_report(chat_id, ym), disable_preview=False)
+def _cb_score_cancel(chat_id:int, uid:int, frm:dict, cb:dict):
+    clear_pending_states(chat_id, uid)
+    popup_html(chat_id, "已退出积分管理。")
+def _cb_news_toggle(chat_id:int, uid:int, frm:dict, cb:dict):
+    en = news_enabled(chat_id); news_set_enabled(chat_id, not en)
+    popup_html(chat_id, f"新闻播报已{'开启' if not en else '关闭'}。")
+def _cb_ad_show(chat_id:int, uid:int, frm:dict, cb:dict):
+    en, ct, mode, times, mt, fid = ad_get(chat_id)
+    info = [
+        f"状态：{'启用' if en else '禁用'}",
+        f"模式：{mode}",
+        f"时间：{times or '（未设置）'}",
+        f"媒体：{mt}{'✅' if fid else ''}",
+        f"文本：{('有' if ct.strip() else '空')}"
+    ]
+    popup_html(chat_id, "📣 <b>广告概览</b>\n" + "\n".join(info))
+def _admin_action(action:Callable[[int,int],object], ok_msg:str="")->Callable:
+    """仅管理员：执行 action(chat_id, uid)，有 ok_msg 则弹出；非管理员记一条 debug 后忽略"""
+    def h(chat_id:int, uid:int, frm:dict, cb:dict):
+        if not is_chat_admin(chat_id, uid):
+            logger.debug("admin-only callback ignored: chat=%s uid=%s data=%s", chat_id, uid, cb.get("data")); return
+        action(chat_id, uid)
+        if ok_msg: popup_html(chat_id, ok_msg)
+    return h
+_SCORE_MODE_HINT="请输入：@用户名 数值；或先<b>回复</b>目标消息后只发“数值”。（/cancel 退出）"
+
+_CB_HANDLERS:Dict[str,Callable]={
+    "ACT_CHECKIN": lambda chat_id, uid, frm, cb: do_checkin(chat_id, uid, frm),
+    "ACT_SCORE": _cb_score,
+    "ACT_TOP10": lambda chat_id, uid, frm, cb: _cmd_top10(chat_id, uid, frm, "/top10", None),
+    "ACT_SD_TODAY": _cb_sd_today,
+    "ACT_SM_THIS": _cb_sm_this,
+    "ACT_RULES": lambda chat_id, uid, frm, cb: _cmd_rules(chat_id, uid, frm, "/rules", None),
+    "ACT_HELP": lambda chat_id, uid, frm, cb: _cmd_help(chat_id, uid, frm, "/help", None),
+    "ACT_REDEEM": lambda chat_id, uid, frm, cb: _handle_command(chat_id, uid, frm, "/redeem", msg=None),
+    # 管理功能
+    "ACT_SCORE_MGR": lambda chat_id, uid, frm, cb: open_score_mgr(chat_id, uid),
+    "ACT_SCORE_ADD": _admin_action(lambda c, u: state_set(f"pending:score:mode:{c}:{u}", "add"), _SCORE_MODE_HINT),
+    "ACT_SCORE_SUB": _admin_action(lambda c, u: state_set(f"pending:score:mode:{c}:{u}", "sub"), _SCORE_MODE_HINT),
+    "ACT_SCORE_CANCEL": _cb_score_cancel,
+    "ACT_NEWS_NOW": lambda chat_id, uid, frm, cb: push_news_once(chat_id),
+    "ACT_NEWS_TOGGLE": _cb_news_toggle,
+    "ACT_AD_SHOW": _cb_ad_show,
+    "ACT_AD_PREVIEW": lambda chat_id, uid, frm, cb: ad_send_now(chat_id, preview_only=True),
+    "ACT_AD_ENABLE": _admin_action(lambda c, u: ad_enable(c, True), "广告已启用。"),
+    "ACT_AD_DISABLE": _admin_action(lambda c, u: ad_enable(c, False), "广告已禁用。"),
+    "ACT_AD_MODE_ATTACH": _admin_action(lambda c, u: ad_set_mode(c, "attach"), "广告模式：附加。"),
+    "ACT_AD_MODE_SCHEDULE": _admin_action(lambda c, u: ad_set_mode(c, "schedule"), "广告模式：定时。"),
+    "ACT_AD_CLEAR": _admin_action(lambda c, u: ad_clear(c), "广告已清空。"),
+    "ACT_AD_SET_TIMES": _admin_action(ad_timepicker_open),
+    "ACT_AD_SET": _admin_action(lambda c, u: pending_mark(c, u, "set_ad_text"), "请发送广告文本（发送后立即保存）。"),
+    "ACT_AD_SET_MEDIA": _admin_action(lambda c, u: pending_mark(c, u, "set_ad_media"), "请发送图片或视频作为广告素材（可带文案）。"),
+}
+
+def _cb_redeem_decide(approve:bool):
+    def h(chat_id:int, uid:int, arg:str):
+        if is_chat_admin(chat_id, uid):
+            admin_redeem_decide(chat_id, int(arg), approve=approve, admin_id=uid)
+        else:
+            popup_html(chat_id, "仅管理员可操作。")
+    return h
+# 带参数的回调：按 "ACTION:arg" 的 ACTION 查表
+_CB_PREFIX_HANDLERS:Dict[str,Callable]={
+    "REDEEM_APPR": _cb_redeem_decide(True),
+    "REDEEM_REJ": _cb_redeem_decide(False),
+}
+
+def _handle_callback(cb: dict):
+    data_s = cb.get("data") or ""
+    msg = cb.get("message") or {}
+    chat_id = (msg.get("chat") or {}).get("id")
+    msg_id = msg.get("message_id") or 0
+    frm = cb.get("from") or {}
+    uid = frm.get("id")
+    cb_id = cb.get("id")
+
+    h = _CB_HANDLERS.get(data_s)
+    if h:
+        h(chat_id, uid, frm, cb); return
+    action, _, arg = data_s.partition(":")
+    h = _CB_PREFIX_HANDLERS.get(action)
+    if h:
+        h(chat_id, uid, arg)
+    elif action.startswith("AT_"):
+        ad_timepicker_handle(chat_id, uid, msg_id, action[3:], arg, cb_id)
+
+_ALLOWED_UPDATES=json.dumps(["message","callback_query"])  # 其余类型（编辑/频道/投票…）本就不处理，让服务端别推
+def _poll_updates(offset:int)->Optional[dict]:
+    params = {"timeout": POLL_TIMEOUT, "offset": offset + 1, "limit": 100, "allowed_updates": _ALLOWED_UPDATES}
+    return http_get("getUpdates", params=params, timeout=POLL_TIMEOUT + 5)
+
+# 预取：拿到一批结果后立刻在后台发下一次 getUpdates，让 Telegram 往返与本地处理重叠。
+# http_get 从不抛异常，队列里必有结果；daemon 线程不会拖住进程退出。
+# 同一 offset 并发 getUpdates 的行为未定义：任何时刻只允许一个在途请求，预取结果必须先取走再发下一次。
+_POLL_NEXT:Optional[Tuple[int,"queue.Queue"]] = None
+def _prefetch_updates(offset:int):
+    global _POLL_NEXT
+    q:"queue.Queue" = queue.Queue(maxsize=1)
+    threading.Thread(target=lambda: q.put(_poll_updates(offset)), name="tg-poll", daemon=True).start()
+    _POLL_NEXT = (offset, q)
+
 def process_updates_once():
+    global _POLL_NEXT
     offset = _next_update_offset()
-    params = {"timeout": POLL_TIMEOUT, "offset": offset + 1}
-    data = http_get("getUpdates", params=params)
+    pre, _POLL_NEXT = _POLL_NEXT, None
+    data = pre[1].get() if pre and pre[0] == offset else _poll_updates(offset)
     if not data or not data.get("ok"):
+        return 0
+    updates = data.get("result") or []
+    if updates:
+        _prefetch_updates(max(offset, max(u.get("update_id", 0) for u in updates)))
+    try:
+        _handle_updates(updates)
+    finally:
+        # 整批处理完（或被中断）才落一次 offset，而不是每条更新写一次库
+        last = max([offset] + [u.get("update_id", 0) for u in updates])
+        if last > offset: _set_update_offset(last)
+        ad_flush()
+    return len(updates)
+
+# 处理异常的完整堆栈按令牌桶限流（每分钟 ERR_TRACEBACKS_PER_MIN 条），报错风暴时只记一行，避免日志把故障放大
+ERR_TRACEBACKS_PER_MIN=10
+_ERR_LOCK=threading.Lock(); _ERR_TOKENS=float(ERR_TRACEBACKS_PER_MIN); _ERR_TS=time.monotonic()
+def _err_budget_allow()->bool:
+    global _ERR_TOKENS, _ERR_TS
+    with _ERR_LOCK:
+        now=time.monotonic()
+        _ERR_TOKENS=min(ERR_TRACEBACKS_PER_MIN, _ERR_TOKENS+(now-_ERR_TS)*ERR_TRACEBACKS_PER_MIN/60.0); _ERR_TS=now
+        if _ERR_TOKENS>=1: _ERR_TOKENS-=1; return True
+        return False
+
+# 更新按 chat_id 分片给固定 worker：不同群并行处理，同一群内（含按钮连点）保持先后顺序
+_UPD_QUEUES:List[queue.Queue]=[]; _UPD_LOCK=threading.Lock()
+def _update_chat_id(upd:dict)->int:
+    m = upd.get("message") or (upd.get("callback_query") or {}).get("message") or {}
+    return (m.get("chat") or {}).get("id") or 0
+def _update_worker(q:queue.Queue):
+    while True:
+        upd = q.get()
+        try: _handle_update(upd)
+        finally: q.task_done()
+# 按钮的转圈在 answerCallbackQuery 之前一直显示：整批一到就交给应答线程池先 ack，不用排在同群前面的更新后面
+_ACK_POOL:Optional[ThreadPoolExecutor]=None
+def _ack_callbacks(updates:List[dict]):
+    global _ACK_POOL
+    ids=[(u.get("callback_query") or {}).get("id") for u in updates if "callback_query" in u]
+    ids=[i for i in ids if i]
+    if not ids: return
+    if _ACK_POOL is None: _ACK_POOL=ThreadPoolExecutor(max_workers=4, thread_name_prefix="cb-ack")
+    for i in ids: _ACK_POOL.submit(answer_callback_query, i)
+
+def _handle_updates(updates:List[dict]):
+    _ack_callbacks(updates)
+    if UPDATE_WORKERS <= 1 or len(updates) <= 1:
+        for upd in updates: _handle_update(upd)
         return
-    for upd in data.get("result") or []:
-        upd_id = upd.get("update_id", 0)
-        try:
-            if "message" in upd:
-                msg = upd["message"]
-                chat = msg.get("chat") or {}
-                chat_id = chat.get("id")
-                frm = msg.get("from") or {}
-                uid = frm.get("id")
-
-                if msg.get("new_chat_members"): handle_new_members(msg)
-                if msg.get("left_chat_member"): handle_left_member(msg)
-
-                text = msg.get("text") or msg.get("caption") or ""
-                if isinstance(text, str) and len(text.strip()) >= MIN_MSG_CHARS:
-                    inc_msg_count(chat_id, frm, tz_now().strftime("%Y-%m-%d"), 1)
-
-                if _handle_pending_inputs(msg):
-                    pass
-                else:
-                    if isinstance(text, str) and text.startswith("/"):
-                        _handle_command(chat_id, uid, frm, text, msg=msg)
-                    elif text in ("菜单","导航","帮助","规则","签到","积分榜","我的积分"):
-                        _handle_command(chat_id, uid, frm, text, msg=msg)
-
-            elif "callback_query" in upd:
-                cb = upd["callback_query"]
-                data_s = cb.get("data") or ""
-                msg = cb.get("message") or {}
-                chat_id = (msg.get("chat") or {}).get("id")
-                frm = cb.get("from") or {}
-                uid = frm.get("id")
-
-                answer_callback_query(cb.get("id"))
-
-                if data_s == "ACT_CHECKIN":
-                    do_checkin(chat_id, uid, frm)
-                elif data_s == "ACT_SCORE":
-                    pts = _get_points(chat_id, uid)
-                    send_ephemeral_html(chat_id, f"你的当前积分：<b>{pts}</b>", POPUP_EPHEMERAL_SECONDS)
-                elif data_s == "ACT_TOP10":
-                    rows = list_score_top(chat_id, 10)
-                    if not rows:
-                        send_ephemeral_html(chat_id, "暂无积分数据。", POPUP_EPHEMERAL_SECONDS)
-                    else:
-                        lines = ["🏆 <b>积分榜 Top10</b>"]
-                        for i,(u,un,fn,ln,pts) in enumerate(rows, 1):
-                            lines.append(f"{i}. {rank_display_link(chat_id, u, un, fn, ln)} — <b>{pts}</b> 分")
-                        send_ephemeral_html(chat_id, "\n".join(lines), POPUP_EPHEMERAL_SECONDS)
-                elif data_s == "ACT_SD_TODAY":
-                    d = tz_now().strftime("%Y-%m-%d")
-                    send_ephemeral_html(chat_id, build_daily_report(chat_id, d), POPUP_EPHEMERAL_SECONDS, disable_preview=False)
-                elif data_s == "ACT_SM_THIS":
-                    ym = tz_now().strftime("%Y-%m")
-                    send_ephemeral_html(chat_id, build_monthly_report(chat_id, ym), POPUP_EPHEMERAL_SECONDS, disable_preview=False)
-                elif data_s == "ACT_RULES":
-                    send_ephemeral_html(chat_id, build_rules_text(chat_id), POPUP_EPHEMERAL_SECONDS)
-                elif data_s == "ACT_HELP":
-                    send_ephemeral_html(chat_id, HELP_TEXT, POPUP_EPHEMERAL_SECONDS)
-                elif data_s == "ACT_REDEEM":
-                    _handle_command(chat_id, uid, frm, "/redeem", msg=None)
-
-                # 管理功能
-                elif data_s == "ACT_SCORE_MGR":
-                    open_score_mgr(chat_id, uid)
-                elif data_s == "ACT_SCORE_ADD":
-                    if is_chat_admin(chat_id, uid):
-                        state_set(f"pending:score:mode:{chat_id}:{uid}", "add")
-                        send_ephemeral_html(chat_id, "请输入：@用户名 数值；或先<b>回复</b>目标消息后只发“数值”。（/cancel 退出）", POPUP_EPHEMERAL_SECONDS)
-                elif data_s == "ACT_SCORE_SUB":
-                    if is_chat_admin(chat_id, uid):
-                        state_set(f"pending:score:mode:{chat_id}:{uid}", "sub")
-                        send_ephemeral_html(chat_id, "请输入：@用户名 数值；或先<b>回复</b>目标消息后只发“数值”。（/cancel 退出）", POPUP_EPHEMERAL_SECONDS)
-                elif data_s == "ACT_SCORE_CANCEL":
-                    clear_pending_states(chat_id, uid)
-                    send_ephemeral_html(chat_id, "已退出积分管理。", POPUP_EPHEMERAL_SECONDS)
-
-                elif data_s == "ACT_NEWS_NOW":
-                    push_news_once(chat_id)
-                elif data_s == "ACT_NEWS_TOGGLE":
-                    en = news_enabled(chat_id); news_set_enabled(chat_id, not en)
-                    send_ephemeral_html(chat_id, f"新闻播报已{'开启' if not en else '关闭'}。", POPUP_EPHEMERAL_SECONDS)
-
-                elif data_s == "ACT_AD_SHOW":
-                    en, ct, mode, times, mt, fid = ad_get(chat_id)
-                    info = [
-                        f"状态：{'启用' if en else '禁用'}",
-                        f"模式：{mode}",
-                        f"时间：{times or '（未设置）'}",
-                        f"媒体：{mt}{'✅' if fid else ''}",
-                        f"文本：{('有' if ct.strip() else '空')}"
-                    ]
-                    send_ephemeral_html(chat_id, "📣 <b>广告概览</b>\n" + "\n".join(info), POPUP_EPHEMERAL_SECONDS)
-                elif data_s == "ACT_AD_PREVIEW":
-                    ad_send_now(chat_id, preview_only=True)
-                elif data_s == "ACT_AD_ENABLE":
-                    if is_chat_admin(chat_id, uid):
-                        ad_enable(chat_id, True); send_ephemeral_html(chat_id, "广告已启用。", POPUP_EPHEMERAL_SECONDS)
-                elif data_s == "ACT_AD_DISABLE":
-                    if is_chat_admin(chat_id, uid):
-                        ad_enable(chat_id, False); send_ephemeral_html(chat_id, "广告已禁用。", POPUP_EPHEMERAL_SECONDS)
-                elif data_s == "ACT_AD_MODE_ATTACH":
-                    if is_chat_admin(chat_id, uid):
-                        ad_set_mode(chat_id, "attach"); send_ephemeral_html(chat_id, "广告模式：附加。", POPUP_EPHEMERAL_SECONDS)
-                elif data_s == "ACT_AD_MODE_SCHEDULE":
-                    if is_chat_admin(chat_id, uid):
-                        ad_set_mode(chat_id, "schedule"); send_ephemeral_html(chat_id, "广告模式：定时。", POPUP_EPHEMERAL_SECONDS)
-                elif data_s == "ACT_AD_CLEAR":
-                    if is_chat_admin(chat_id, uid):
-                        ad_clear(chat_id); send_ephemeral_html(chat_id, "广告已清空。", POPUP_EPHEMERAL_SECONDS)
-                elif data_s == "ACT_AD_SET_TIMES":
-                    if is_chat_admin(chat_id, uid):
-                        ad_timepicker_open(chat_id, uid)
-                elif data_s == "ACT_AD_SET":
-                    if is_chat_admin(chat_id, uid):
-                        state_set(f"pending:set_ad_text:{chat_id}:{uid}", "1")
-                        send_ephemeral_html(chat_id, "请发送广告文本（发送后立即保存）。", POPUP_EPHEMERAL_SECONDS)
-                elif data_s == "ACT_AD_SET_MEDIA":
-                    if is_chat_admin(chat_id, uid):
-                        state_set(f"pending:set_ad_media:{chat_id}:{uid}", "1")
-                        send_ephemeral_html(chat_id, "请发送图片或视频作为广告素材（可带文案）。", POPUP_EPHEMERAL_SECONDS)
-
-                elif data_s.startswith("REDEEM_APPR:") or data_s.startswith("REDEEM_REJ:"):
-                    rid = int(data_s.split(":",1)[1])
-                    if is_chat_admin(chat_id, uid):
-                        approve = data_s.startswith("REDEEM_APPR:")
-                        admin_redeem_decide(chat_id, rid, approve=approve, admin_id=uid)
-                    else:
-                        send_ephemeral_html(chat_id, "仅管理员可操作。", POPUP_EPHEMERAL_SECONDS)
-
-                elif data_s.startswith("AT_"):
-                    ad_timepicker_handle(chat_id, uid, (msg.get("message_id") or 0), data_s, cb.get("id"))
+    if not _UPD_QUEUES:
+        with _UPD_LOCK:
+            if not _UPD_QUEUES:
+                for i in range(UPDATE_WORKERS):
+                    q=queue.Queue(); threading.Thread(target=_update_worker, args=(q,), name=f"upd-{i}", daemon=True).start(); _UPD_QUEUES.append(q)
+    for upd in updates:
+        _UPD_QUEUES[hash(_update_chat_id(upd)) % len(_UPD_QUEUES)].put(upd)
+    for q in _UPD_QUEUES: q.join()  # 整批处理完才返回，offset 由调用方随后落盘
+
+def _handle_update(upd:dict):
+    try:
+        if "message" in upd:
+            msg = upd["message"]
+            chat = msg.get("chat") or {}
+            chat_id = chat.get("id")
+            frm = msg.get("from") or {}
+            uid = frm.get("id")
+
+            if msg.get("new_chat_members"): handle_new_members(msg)
+            if msg.get("left_chat_member"): handle_left_member(msg)
+
+            text = msg.get("text") or msg.get("caption") or ""
+            if isinstance(text, str) and len(text.strip()) >= MIN_MSG_CHARS:
+                inc_msg_count(chat_id, frm, tz_now().strftime("%Y-%m-%d"), 1)
+
+            if _handle_pending_inputs(msg):
+                pass
+            else:
+                if isinstance(text, str) and text.startswith("/"):
+                    _handle_command(chat_id, uid, frm, text, msg=msg)
+                elif text in ("菜单","导航","帮助","规则","签到","积分榜","我的积分"):
+                    _handle_command(chat_id, uid, frm, text, msg=msg)
 
-        except Exception as e:
-            logger.exception("update handle error: %s", e)
-        finally:
-            if upd_id > offset:
-                offset = upd_id
-                _set_update_offset(offset)
+        elif "callback_query" in upd:
+            _handle_callback(upd["callback_query"])
+
+    except Exception as e:
+        if _err_budget_allow(): logger.exception("update handle error: %s", e)
+        else: logger.error("update handle error (traceback suppressed): %r", e)
 
 # ------------------------------- 启动主循环 -------------------------------
+def scheduler_loop():
+    """定时任务独立线程：推新闻/发报表卡住时不影响收消息，长轮询也不会拖过分钟触发点"""
+    while True:
+        t0 = time.monotonic()
+        try:
+            scheduler_step()
+        except Exception:
+            logger.exception("scheduler error")
+        time.sleep(max(0.0, SCHEDULER_INTERVAL - (time.monotonic() - t0)))
+
 def main():
     print(f"[boot] TZ={LOCAL_TZ_NAME}, MYSQL={MYSQL_USER}@{MYSQL_HOST}:{MYSQL_PORT}/{MYSQL_DB}")
     try:
         get_conn(); init_db()
-        logger.info("boot ok | %s", json.dumps(
-            {"event":"boot","cmd":f"{LOCAL_TZ_NAME} poll={POLL_TIMEOUT}s http={HTTP_TIMEOUT}s news_interval={INTERVAL_MINUTES}m"},
-            ensure_ascii=False))
+        logger.info("boot ok | %s", _jdumps(
+            {"event":"boot","cmd":f"{LOCAL_TZ_NAME} poll={POLL_TIMEOUT}s http={HTTP_TIMEOUT}s news_interval={INTERVAL_MINUTES}m"}))
     except Exception:
         logger.exception("boot error"); sys.exit(1)
 
+    threading.Thread(target=scheduler_loop, name="scheduler", daemon=True).start()
     while True:
+        t0 = time.monotonic(); n = 0
         try:
-            scheduler_step()
-        except Exception:
-            logger.exception("scheduler error")
-        try:
-            process_updates_once()
+            n = process_updates_once()
         except KeyboardInterrupt:
             print("bye"); break
         except Exception:
             logger.exception("updates loop error"); time.sleep(2)
+        # 长轮询本身负责空闲等待；只有 getUpdates 空手立即返回（出错/被限流）时才补睡，防止空转
+        if not n and time.monotonic() - t0 < 1.0:
+            time.sleep(1.0)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file